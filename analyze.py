@@ -1,13 +1,21 @@
 import argparse
+import hashlib
 import json
+import os
 import sqlite3
-import re
-import pandas
-import csv
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import chain
+from operator import itemgetter
 from statistics import median
-from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.cluster import KMeans
-from os import remove
+from insert import (device_columns, table_columns, is_legacy_table, decode_results, results_json, results_json_sql,
+                    validate, iter_p)
+from sketch import QuantileSketch
+
+# numpy, pandas and sklearn are imported by the functions that use them, so that quick queries
+# like --rowid or --bugs don't pay for loading them
 
 
 weakening_sw_tests = ["messagePassing", "messagePassingBarrier1", "messagePassingBarrier2", "loadBuffer", "loadBufferBarrier1", "loadBufferBarrier2", "store", "storeBarrier1", "storeBarrier2", "readRMW", "readRMWBarrier1", "readRMWBarrier2", "storeBufferRMW", "storeBufferRMWBarrier1", "storeBufferRMWBarrier2", "twoPlusTwoWriteRMW", "twoPlusTwoWriteRMWBarrier1", "twoPlusTwoWriteRMWBarrier2"]
@@ -22,9 +30,6 @@ reversing_po_loc_tests = ["rrMutant", "rrRMWMutant", "rwMutant", "rwRMWMutant",
 
 all_tuning_tests = weakening_sw_tests + weakening_po_loc_tests + reversing_po_loc_tests
 
-# Pattern for checking that key matches a number
-iter_p = re.compile('\d+')
-
 def load_stats(stats_path):
     """
     Load the file with the test run output
@@ -37,37 +42,157 @@ def load_stats(stats_path):
 def total_behaviors(test_data):
     return test_data["seq"] + test_data["interleaved"] + test_data["weak"]
 
-def run_query(cursor, vendor, is_legacy, mobile):
-    query = "select rowid, results from tuning_results"
+# Filters on columns of tuning_results other than the vendor, e.g. {"browser": "Chrome"}
+filter_columns = ["architecture", "description", "browser", "framework"]
+
+# The where clause of the rows run_query returns, and its values
+def query_filter(cursor, vendor, is_legacy, mobile, rowids=None, filters=None):
+    columns = table_columns(cursor)
+    conditions = []
+    values = []
     if vendor:
-        query += " where gpu_vendor = '{}'".format(vendor)
-    if not mobile and not is_legacy:
-        if vendor:
-            query += " and "
-        else:
-            query += " where "
-        query += "os != '{}'".format("Android")
-    return cursor.execute(query)
+        conditions.append("gpu_vendor = ?")
+        values.append(vendor)
+    # Legacy tables have no os column
+    if not mobile and not is_legacy and "os" in columns:
+        # Legacy results inserted into a table with an os column leave it null
+        conditions.append("os is not ?")
+        values.append("Android")
+    for name in filter_columns:
+        if filters and filters.get(name) is not None:
+            if name not in columns and name in dict(device_columns):
+                raise SystemExit("Database has no {} column, run insert.py --migrate first".format(name))
+            if name not in columns:
+                raise SystemExit("Database has no {} column, legacy results can't be filtered by it".format(name))
+            conditions.append("{} = ?".format(name))
+            values.append(filters[name])
+    # Results that failed validation when they were inserted are left out, unless asked for
+    if "valid" in columns and not (filters and filters.get("include_invalid")):
+        conditions.append("valid is not 0")
+    if rowids:
+        conditions.append("rowid between ? and ?")
+        values += [int(rowids[0]), int(rowids[1])]
+    if conditions:
+        return " where " + " and ".join(conditions), values
+    return "", values
 
-# Make sure every test has completed the expected number of test instances
-def checksum(dataset):
-    for key in dataset:
-        if iter_p.match(key):
-            wg = dataset[key]["params"]["testingWorkgroups"]
-            iterations = dataset[key]["params"]["iterations"]
-            wg_size = dataset[key]["params"]["workgroupSize"]
-            for test in dataset[key]:
-                if test != "params":
-                    expected = iterations * wg * wg_size
-                    if total_behaviors(dataset[key][test]) != expected:
-                        print("Checksum did not match! Iteration: {}, Test: {}, Expected: {}, Actual: {}".format(key, test, expected, total))
-                        return False
-    return True
+def run_query(cursor, vendor, is_legacy, mobile, column="results", rowids=None, filters=None):
+    where, values = query_filter(cursor, vendor, is_legacy, mobile, rowids, filters)
+    return cursor.execute("select rowid, {} from tuning_results{} order by rowid".format(column, where), values)
+
+# The validation errors of the matching results, from the valid column filled in by insert.py, or by checking
+# the results of rows inserted before it existed
+def invalid_rows(cursor, vendor, is_legacy, mobile, filters=None):
+    filters = dict(filters or {}, include_invalid=True)
+    invalid = {}
+    if "valid" in table_columns(cursor):
+        column = "valid, validation_error, case when valid is null then results end"
+    else:
+        column = "null, null, results"
+    for rowid, valid, error, results in run_query(cursor, vendor, is_legacy, mobile, column, filters=filters):
+        if valid is None:
+            error = validate(decode_results(results), is_legacy)
+            if error:
+                invalid[rowid] = error
+        elif not valid:
+            invalid[rowid] = json.loads(error)
+    return invalid
 
 def db_conn(db_path):
     con = sqlite3.connect(db_path)
+    con.create_function("results_json", 1, results_json, deterministic=True)
     return con.cursor()
 
+# Wall time, rows and bytes decoded per phase of an analysis. Hot loops take a timer and call lap() after each
+# phase, which does nothing unless profiling is enabled.
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.phases = {}
+        self.start = time.perf_counter()
+
+    def enable(self):
+        self.enabled = True
+        self.start = time.perf_counter()
+
+    def add(self, phase, seconds, rows=1, num_bytes=0):
+        if phase not in self.phases:
+            self.phases[phase] = {"seconds": 0, "rows": 0, "bytes": 0}
+        self.phases[phase]["seconds"] += seconds
+        self.phases[phase]["rows"] += rows
+        self.phases[phase]["bytes"] += num_bytes
+
+    def timer(self):
+        if self.enabled:
+            return PhaseTimer(self)
+        return null_timer
+
+    @contextmanager
+    def phase(self, phase, rows=0):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        yield
+        self.add(phase, time.perf_counter() - start, rows)
+
+    def summary(self):
+        phases = {}
+        for phase in self.phases:
+            seconds = self.phases[phase]["seconds"]
+            phases[phase] = dict(self.phases[phase])
+            phases[phase]["rowsPerSecond"] = self.phases[phase]["rows"] / seconds if seconds else None
+            if self.phases[phase]["bytes"]:
+                phases[phase]["MBPerSecond"] = self.phases[phase]["bytes"] / seconds / 1000000
+        return {
+            "totalSeconds": time.perf_counter() - self.start,
+            "bytesDecoded": sum(phase["bytes"] for phase in self.phases.values()),
+            "peakMemoryMB": peak_rss_mb(),
+            "phases": phases
+        }
+
+    def report(self, path=None):
+        summary = json.dumps(self.summary(), indent=2)
+        if path:
+            with open(path, "w") as out_file:
+                out_file.write(summary)
+        else:
+            # stdout holds the analysis results
+            print(summary, file=sys.stderr)
+
+class PhaseTimer:
+    def __init__(self, profiler):
+        self.profiler = profiler
+        self.last = time.perf_counter()
+
+    # Starts timing again, e.g. after yielding a row, so the consumer's time isn't counted
+    def restart(self):
+        self.last = time.perf_counter()
+
+    def lap(self, phase, rows=1, num_bytes=0):
+        now = time.perf_counter()
+        self.profiler.add(phase, now - self.last, rows, num_bytes)
+        self.last = now
+
+class NullTimer:
+    def restart(self):
+        pass
+
+    def lap(self, phase, rows=1, num_bytes=0):
+        pass
+
+null_timer = NullTimer()
+
+profiler = Profiler()
+
+def peak_rss_mb():
+    import resource
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / 1000000
+    return peak / 1000
+
 def stats_per_test(dataset, is_legacy):
     result = {}
     test_results = {}
@@ -125,6 +250,284 @@ def stats_per_test(dataset, is_legacy):
     return result
 
 
+# Flattens the iterations of a dataset into one entry per (iteration, test), in dataset order
+def flatten_dataset(dataset):
+    import numpy as np
+    keys = []
+    codes = {}
+    test_codes = []
+    iterations = []
+    tuning = []
+    values = []
+    get_values = itemgetter("seq", "interleaved", "weak", "durationSeconds")
+    previous_names = None
+    for key in dataset:
+        if iter_p.match(key):
+            iteration = dataset[key]
+            names = [test_key for test_key in iteration if test_key != "params"]
+            # Tuning iterations almost always list the same tests, so their codes can be reused
+            if names != previous_names:
+                names_codes = [codes.setdefault(name, len(codes)) for name in names]
+                previous_names = names
+            test_codes += names_codes
+            iterations += [len(keys)] * len(names)
+            # Conformance iterations only contain one test and the params
+            tuning += [len(iteration.keys()) > 2] * len(names)
+            test_data = [iteration[name] for name in names]
+            try:
+                values += list(chain.from_iterable(map(get_values, test_data)))
+            except KeyError:
+                # Legacy results have no durations
+                for data in test_data:
+                    values += [data["seq"], data["interleaved"], data["weak"], data.get("durationSeconds", np.nan)]
+            keys.append(key)
+    # Counts are exact in float64, so everything is read into one array
+    values = np.array(values, dtype=np.float64).reshape(-1, 4)
+    return {
+        "keys": keys,
+        "tests": list(codes),
+        "test_codes": np.array(test_codes, dtype=np.int64),
+        "iterations": np.array(iterations, dtype=np.int64),
+        "tuning": np.array(tuning, dtype=bool),
+        "counts": values[:, :3].astype(np.int64),
+        "durations": values[:, 3]
+    }
+
+# First entry with the highest rate per test, ordered by the first entry of each test in mask
+def best_entries(flat, rates, mask):
+    import numpy as np
+    entries = np.flatnonzero(mask)
+    results = {}
+    if len(entries) == 0:
+        return results
+    codes = flat["test_codes"][entries]
+    order = entries[np.lexsort((entries, -rates[entries], codes))]
+    sorted_codes = flat["test_codes"][order]
+    best = order[np.r_[True, sorted_codes[1:] != sorted_codes[:-1]]]
+    first_seen = np.unique(codes, return_index=True)[1]
+    for entry in best[np.argsort(first_seen)]:
+        results[flat["tests"][flat["test_codes"][entry]]] = {
+            "iteration": flat["keys"][flat["iterations"][entry]],
+            "behavior_rate": float(rates[entry])
+        }
+    return results
+
+# Same output as stats_per_test, computed with array operations over the flattened dataset
+def stats_per_test_np(dataset, is_legacy):
+    return flat_stats(flatten_dataset(dataset), is_legacy)
+
+def flat_stats(flat, is_legacy):
+    import numpy as np
+    result = {}
+    counts = flat["counts"]
+    totals = counts.sum(axis=1)
+    weak = counts[:, 2]
+    rates = weak / totals
+    weak_tests = set(weak_count_tests(is_legacy))
+    counted = np.array([test in weak_tests for test in flat["tests"]], dtype=bool)[flat["test_codes"]]
+    conformance = set(conformance_tests)
+    is_conformance = np.array([test in conformance for test in flat["tests"]], dtype=bool)[flat["test_codes"]]
+    # A test running longer than a minute means the computer went to sleep, so the next test counts
+    # once more for every such test before it (see stats_per_test)
+    durations = flat["durations"][~np.isnan(flat["durations"])]
+    sleeping = durations > 60
+    time = 0
+    if (~sleeping).any():
+        index = np.arange(len(durations))
+        last_awake = np.maximum.accumulate(np.where(sleeping, -1, index))
+        multipliers = index - np.r_[-1, last_awake[:-1]]
+        # cumsum adds in order, so the result matches the sequential sum
+        time = float(np.cumsum(durations[~sleeping] * multipliers[~sleeping])[-1])
+    result["tests"] = best_entries(flat, rates, flat["tuning"])
+    result["bugs"] = best_entries(flat, rates, ~flat["tuning"] & (weak > 0) & is_conformance)
+    result["time"] = time
+    result["weakTestInstances"] = int(totals[counted].sum())
+    result["weakBehaviors"] = int(weak[counted].sum())
+    return result
+
+def compute_stats(dataset, is_legacy, engine):
+    if engine == "numpy":
+        return stats_per_test_np(dataset, is_legacy)
+    return stats_per_test(dataset, is_legacy)
+
+def weak_count_tests(is_legacy):
+    tests = weakening_sw_tests + weakening_po_loc_tests + conformance_tests
+    if is_legacy:
+        tests = tests + vulkan_weak_mem_tests
+    return tests
+
+def sql_list(values):
+    return ", ".join("?" for _ in values)
+
+# Databases shredded by older versions of insert.py lack the hash table or the indexes the queries need
+def has_shredded(cursor):
+    query = "select count(*) from sqlite_master where name in ('shredded_results', 'test_results_stats', 'test_results_durations')"
+    return cursor.execute(query).fetchone()[0] == 3
+
+# Same output as stats_per_test for every result in rows, a query of rowids, computed by a few queries over the
+# normalized test_results table. With fields="bugs" only the bugs are complete.
+def stats_sql(cursor, rows, values, is_legacy, fields="all"):
+    if not has_shredded(cursor):
+        raise SystemExit("Database has no test_results table, run insert.py --migrate first")
+    query = "select count(*) from tuning_results where rowid in ({}) and rowid not in (select result_id from shredded_results)"
+    missing = cursor.execute(query.format(rows), values).fetchone()[0]
+    if missing:
+        raise SystemExit("{} results aren't in the test_results table, run insert.py --migrate first".format(missing))
+    results = {}
+    for row in cursor.execute("select rowid from tuning_results where rowid in ({})".format(rows), values):
+        results[row[0]] = {"tests": {}, "bugs": {}, "time": 0, "weakTestInstances": 0, "weakBehaviors": 0}
+    # One pass over the covering index per query. Its rows are in position order within each group, and SQLite takes
+    # the bare iteration from the first row with the max() rate, so it is the same entry best_entries picks. Entries
+    # are then ordered by the first position of their test, like the original dict insertion.
+    best_query = """
+        select result_id, tuning, test, iteration, max(cast(weak as real) / (seq + interleaved + weak)),
+            sum(seq + interleaved + weak), sum(weak),
+            (select min(position) from test_results as first indexed by test_results_stats
+             where first.result_id = entries.result_id and first.tuning = entries.tuning and first.test = entries.test{})
+        from test_results as entries indexed by test_results_stats
+        where result_id in ({}) {} group by result_id, tuning, test"""
+    bug_filter = "and tuning = 0 and weak > 0 and test in ({})".format(sql_list(conformance_tests))
+    query = best_query.format(" and first.weak > 0", rows, bug_filter)
+    bugs = cursor.execute(query, values + conformance_tests).fetchall()
+    for result_id, tuning, test, iteration, rate, total, weak, first in sorted(bugs, key=lambda row: (row[0], row[7])):
+        results[result_id]["bugs"][test] = {
+            "iteration": str(iteration),
+            "behavior_rate": rate
+        }
+    if fields == "bugs":
+        return results
+    weak_tests = weak_count_tests(is_legacy)
+    groups = cursor.execute(best_query.format("", rows, ""), values).fetchall()
+    for result_id, tuning, test, iteration, rate, total, weak, first in sorted(groups, key=lambda row: (row[0], row[7])):
+        if tuning:
+            results[result_id]["tests"][test] = {
+                "iteration": str(iteration),
+                "behavior_rate": rate
+            }
+        if test in weak_tests:
+            results[result_id]["weakTestInstances"] += total
+            results[result_id]["weakBehaviors"] += weak
+    # Same sleep correction as stats_per_test: a test longer than a minute counts 0, and the next shorter one counts
+    # once more for each. SQLite sums in its own order, so the time can differ from the other engines in the last digits.
+    time_query = """
+        select result_id, sum(duration_seconds) from (
+            select result_id, duration_seconds from test_results indexed by test_results_durations
+            where result_id in ({0}) and duration_seconds <= 60
+            union all
+            select result_id, (select duration_seconds from test_results as next indexed by test_results_durations
+                               where next.result_id = asleep.result_id and next.position > asleep.position and next.duration_seconds <= 60
+                               order by next.position limit 1)
+            from test_results as asleep indexed by test_results_durations
+            where result_id in ({0}) and duration_seconds > 60
+        ) where duration_seconds is not null group by result_id"""
+    for result_id, time in cursor.execute(time_query.format(rows), values + values):
+        results[result_id]["time"] = time
+    return results
+
+# Cached stats are invalidated whenever the code computing them changes
+# A hash of every function the per row stats come from, and of the engine if given, so stats cached or merged by
+# other versions of them are never reused
+def stats_version(engine=None):
+    import inspect
+    functions = [compute_stats, stats_per_test, stats_per_test_np, flatten_dataset, flat_stats, best_entries, weak_count_tests,
+                 stats_sql, total_behaviors]
+    source = "".join(inspect.getsource(function) for function in functions)
+    source += json.dumps([weakening_sw_tests, weakening_po_loc_tests, conformance_tests, vulkan_weak_mem_tests, engine])
+    return hashlib.sha256(source.encode()).hexdigest()
+
+def check_stats_cache(cursor):
+    exists = cursor.execute("select 1 from sqlite_master where type = 'table' and name = 'stats_cache'").fetchone()
+    if not exists or "content_hash" not in table_columns(cursor):
+        raise SystemExit("Database has no stats cache, run insert.py --migrate first")
+
+def cached_row_stats(cursor, vendor, is_legacy, mobile, engine, rowids=None, filters=None):
+    check_stats_cache(cursor)
+    version = stats_version(engine)
+    cached = {}
+    query = "select result_id, results_hash, stats, platform_info from stats_cache where legacy = ? and version = ?"
+    for row in cursor.execute(query, [is_legacy, version]):
+        cached[row[0]] = row[1:]
+    stats_cursor = cursor.connection.cursor()
+    misses = []
+    timer = profiler.timer()
+    rows = run_query(cursor, vendor, is_legacy, mobile, "content_hash", rowids, filters).fetchall()
+    timer.lap("fetch", len(rows))
+    # Rows changed since insert.py last filled in their hash aren't cached
+    hits = {rowid for rowid, results_hash in rows if results_hash is not None and rowid in cached and cached[rowid][0] == results_hash}
+    if engine == "sql":
+        # The misses are computed together, like row_stats does
+        missed = json.dumps([rowid for rowid, results_hash in rows if rowid not in hits])
+        sql_stats = stats_sql(stats_cursor, "select value from json_each(?)", [missed], is_legacy)
+        query = "select rowid, json_extract({}, '$.platformInfo') from tuning_results where rowid in (select value from json_each(?))"
+        platform_infos = dict(stats_cursor.execute(query.format(results_json_sql), [missed]).fetchall())
+        timer.lap("stats", len(rows) - len(hits))
+    for row in rows:
+        rowid, results_hash = row
+        if rowid in hits:
+            res = rowid, {"platformInfo": json.loads(cached[rowid][2])}, json.loads(cached[rowid][1])
+            timer.lap("cache", 1, len(cached[rowid][1]) + len(cached[rowid][2]))
+            yield res
+            timer.restart()
+            continue
+        if engine == "sql":
+            data = {"platformInfo": json.loads(platform_infos[rowid])}
+            timer.lap("decode", 1, len(platform_infos[rowid]))
+            stats = sql_stats[rowid]
+        else:
+            stats_cursor.execute("select results from tuning_results where rowid = ?", [rowid])
+            results = stats_cursor.fetchone()[0]
+            timer.lap("fetch", 0)
+            data = decode_results(results, skip_params=True)
+            timer.lap("decode", 1, len(results))
+            stats = compute_stats(data, is_legacy, engine)
+        timer.lap("stats")
+        if results_hash is not None:
+            misses.append((rowid, is_legacy, results_hash, version, json.dumps(stats), json.dumps(data["platformInfo"])))
+        yield rowid, data, stats
+        timer.restart()
+    stats_cursor.executemany("insert or replace into stats_cache values (?, ?, ?, ?, ?, ?)", misses)
+    cursor.connection.commit()
+
+# Parts of the results each analysis reads. Bugs are only looked for in conformance iterations, which
+# have at most one test besides the params, so the tuning iterations are left out by SQLite before decoding.
+projections = {
+    "all": "results",
+    # Compressed results would have to be decoded in Python to be projected, so they are returned whole
+    "bugs": """(case when typeof(results) = 'text' then (select json_group_object(part.key, part.value) from json_each(results) as part
+                where part.key = 'platformInfo' or (part.key glob '[0-9]*' and (select count(*) from json_each(part.value)) <= 2))
+                else results end)"""
+}
+
+# Yields (rowid, data, stats) for every matching row. The sql engine and the cache only decode
+# platformInfo, so data holds just that key. None of the analyses use the params, so they aren't decoded,
+# and with fields="bugs" only the bugs in stats are complete.
+def row_stats(cursor, vendor, is_legacy, mobile, engine="json", cache=False, rowids=None, filters=None, fields="all"):
+    if cache:
+        yield from cached_row_stats(cursor, vendor, is_legacy, mobile, engine, rowids, filters)
+    elif engine == "sql":
+        timer = profiler.timer()
+        rows = run_query(cursor, vendor, is_legacy, mobile, "json_extract({}, '$.platformInfo')".format(results_json_sql), rowids, filters).fetchall()
+        timer.lap("fetch", len(rows))
+        where, values = query_filter(cursor, vendor, is_legacy, mobile, rowids, filters)
+        stats = stats_sql(cursor, "select rowid from tuning_results" + where, values, is_legacy, fields)
+        timer.lap("stats", len(rows))
+        for rowid, platform_info in rows:
+            data = {"platformInfo": json.loads(platform_info)}
+            timer.lap("decode", 1, len(platform_info))
+            yield rowid, data, stats[rowid]
+            timer.restart()
+    else:
+        timer = profiler.timer()
+        for row in run_query(cursor, vendor, is_legacy, mobile, projections[fields], rowids, filters):
+            timer.lap("fetch")
+            data = decode_results(row[1], skip_params=True)
+            timer.lap("decode", 1, len(row[1]))
+            stats = compute_stats(data, is_legacy, engine)
+            timer.lap("stats")
+            yield row[0], data, stats
+            timer.restart()
+
+
 def init_weak_mem_counts(is_legacy):
     res = {}
     if is_legacy:
@@ -135,14 +538,20 @@ def init_weak_mem_counts(is_legacy):
         res[test] = 0
     return res
 
-def init_weak_mem_rates(is_legacy):
+# Exact quantiles keep every value in a list, sketch quantiles a QuantileSketch of bounded size
+def init_values(quantiles):
+    if quantiles == "sketch":
+        return QuantileSketch()
+    return []
+
+def init_weak_mem_rates(is_legacy, quantiles="exact"):
     res = {}
     if is_legacy:
         tests = vulkan_weak_mem_tests
     else:
         tests = weakening_po_loc_tests
     for test in tests:
-        res[test] = []
+        res[test] = init_values(quantiles)
     return res
 
 def init_weak_mem_maxes(is_legacy):
@@ -197,7 +606,7 @@ def update_weak_mem_rates(results, key, rowid, data, stats, is_legacy):
             }
 
 
-def init_group_by(results, key, is_legacy):
+def init_group_by(results, key, is_legacy, quantiles="exact"):
     # rates is the average rate of weak behaviors per test, while count is
     # the number of devices that show weak behaviors per test
     results[key] = {
@@ -205,8 +614,8 @@ def init_group_by(results, key, is_legacy):
         "weakTestInstances": 0,
         "weakBehaviors": 0,
         "time": 0,
-        "times": [],
-        "rates": init_weak_mem_rates(is_legacy),
+        "times": init_values(quantiles),
+        "rates": init_weak_mem_rates(is_legacy, quantiles),
         "counts": init_weak_mem_counts(is_legacy),
         "maxRates": init_weak_mem_maxes(is_legacy),
         "minRates": init_weak_mem_mins(is_legacy),
@@ -244,6 +653,167 @@ def update_group_by(results, key, rowid, data, stats, is_legacy):
         else:
             results[key]["platforms"][platform] += 1
 
+def merge_group_by(results, other):
+    results["total"] += other["total"]
+    if isinstance(results["times"], QuantileSketch):
+        results["times"].merge(other["times"])
+        results["time"] += other["time"]
+    else:
+        results["times"] += other["times"]
+        # Summing the times in row order gives exactly the total of a single pass
+        results["time"] = sum(results["times"])
+    results["weakTestInstances"] += other["weakTestInstances"]
+    results["weakBehaviors"] += other["weakBehaviors"]
+    for test in results["rates"]:
+        if isinstance(results["rates"][test], QuantileSketch):
+            results["rates"][test].merge(other["rates"][test])
+        else:
+            results["rates"][test] += other["rates"][test]
+        results["counts"][test] += other["counts"][test]
+        # Ties keep the earlier row, like update_weak_mem_rates
+        if other["maxRates"][test]["rate"] > results["maxRates"][test]["rate"]:
+            results["maxRates"][test] = other["maxRates"][test]
+        if other["minRates"][test]["rate"] < results["minRates"][test]["rate"]:
+            results["minRates"][test] = other["minRates"][test]
+    for vendor_arch in other["devices"]:
+        if vendor_arch not in results["devices"]:
+            results["devices"][vendor_arch] = {}
+        for description in other["devices"][vendor_arch]:
+            count = other["devices"][vendor_arch][description]
+            results["devices"][vendor_arch][description] = results["devices"][vendor_arch].get(description, 0) + count
+    results["uniqueDevices"] = sum(len(descriptions) for descriptions in results["devices"].values())
+    for platform in other["platforms"]:
+        results["platforms"][platform] = results["platforms"].get(platform, 0) + other["platforms"][platform]
+
+class GroupStats:
+    # Accumulates the groups of analyze(). Accumulators of consecutive ranges of rows, merged in
+    # row order, give the same result as a single pass over all rows.
+    def __init__(self, group_by, is_legacy, quantiles="exact"):
+        self.group_by = group_by
+        self.is_legacy = is_legacy
+        self.quantiles = quantiles
+        self.results = {}
+
+    def update(self, rowid, data, stats):
+        if self.group_by == "indiv":
+            # Every row gets its own total
+            key = rowid
+        elif self.group_by == "vendor":
+            # Group by vendor
+            key = data["platformInfo"]["gpu"]["vendor"]
+        elif self.group_by == "arch":
+            key = arch_str(data["platformInfo"]["gpu"])
+        elif self.group_by == "device":
+            key = device_str(data["platformInfo"]["gpu"])
+        elif self.group_by == "all":
+            key = "all"
+        elif self.group_by == "source":
+            # Only rows of federated analyses are tagged with their database
+            key = data["source"]
+        else:
+            return
+        if key not in self.results:
+            init_group_by(self.results, key, self.is_legacy, self.quantiles)
+        update_group_by(self.results, key, rowid, data, stats, self.is_legacy)
+
+    def merge(self, other):
+        for key in other.results:
+            if key not in self.results:
+                self.results[key] = other.results[key]
+            else:
+                merge_group_by(self.results[key], other.results[key])
+        return self
+
+    # The groups as JSON, as pairs so the rowid keys of indiv keep their type
+    def dumps(self):
+        return json.dumps(list(self.results.items()), default=QuantileSketch.to_dict)
+
+    def loads(self, state):
+        self.results = dict(json.loads(state))
+        if self.quantiles == "sketch":
+            for group in self.results.values():
+                group["times"] = QuantileSketch.from_dict(group["times"])
+                for test in group["rates"]:
+                    group["rates"][test] = QuantileSketch.from_dict(group["rates"][test])
+        return self
+
+    def finish(self):
+        results = self.results
+        for key in results:
+            results[key]["avgRates"] = {}
+            results[key]["medianRates"] = {}
+            results[key]["rateQuantiles"] = {}
+            # Get the median and average rates per test
+            for test in results[key]["rates"]:
+                rates = results[key]["rates"][test]
+                if isinstance(rates, QuantileSketch):
+                    results[key]["avgRates"][test] = rates.sum/results[key]["total"]
+                    results[key]["medianRates"][test] = rates.quantile(0.5)
+                    results[key]["rateQuantiles"][test] = sketch_quantiles(rates)
+                    # The sketch itself is returned, so results can be merged later on
+                    results[key]["rates"][test] = rates.to_dict()
+                else:
+                    results[key]["avgRates"][test] = sum(rates)/results[key]["total"]
+                    results[key]["medianRates"][test] = median(rates)
+                    results[key]["rateQuantiles"][test] = exact_quantiles(rates)
+            if isinstance(results[key]["times"], QuantileSketch):
+                results[key]["timeQuantiles"] = sketch_quantiles(results[key]["times"])
+                results[key]["times"] = results[key]["times"].to_dict()
+            else:
+                results[key]["timeQuantiles"] = exact_quantiles(results[key]["times"])
+        return results
+
+quantile_points = {"p50": 0.5, "p90": 0.9, "p99": 0.99}
+
+# Interpolates between the closest ranks, like numpy.percentile
+def exact_quantiles(values):
+    values = sorted(values)
+    res = {}
+    for name in quantile_points:
+        position = (len(values) - 1) * quantile_points[name]
+        lower = int(position)
+        upper = min(lower + 1, len(values) - 1)
+        res[name] = values[lower] + (values[upper] - values[lower]) * (position - lower)
+    return res
+
+def sketch_quantiles(sketch):
+    return {name: sketch.quantile(quantile_points[name]) for name in quantile_points}
+
+def database_path(cursor):
+    return cursor.execute("pragma database_list").fetchone()[2]
+
+# Splits the matching rows into consecutive rowid ranges
+def rowid_ranges(cursor, vendor, is_legacy, mobile, chunks, filters=None):
+    rowids = [row[0] for row in run_query(cursor, vendor, is_legacy, mobile, "rowid", filters=filters)]
+    size = max(1, -(-len(rowids) // chunks))
+    return [(rowids[i], rowids[min(i + size, len(rowids)) - 1]) for i in range(0, len(rowids), size)]
+
+# Runs worker over rowid ranges in a process pool, returning the partial results in row order
+def map_ranges(cursor, worker, vendor, is_legacy, mobile, engine, cache, jobs, arg=None, filters=None):
+    from multiprocessing import Pool
+    if cache:
+        check_stats_cache(cursor)
+    db_path = database_path(cursor)
+    tasks = []
+    for rowids in rowid_ranges(cursor, vendor, is_legacy, mobile, jobs * 4, filters):
+        tasks.append((db_path, vendor, is_legacy, mobile, engine, cache, rowids, filters, arg))
+    with Pool(jobs) as pool:
+        return pool.map(worker, tasks)
+
+def range_rows(task, fields="all"):
+    db_path, vendor, is_legacy, mobile, engine, cache, rowids, filters, arg = task
+    return row_stats(db_conn(db_path), vendor, is_legacy, mobile, engine, cache, rowids, filters, fields)
+
+def group_range(task):
+    group_by, quantiles = task[-1]
+    group_stats = GroupStats(group_by, task[2], quantiles)
+    for rowid, data, stats in range_rows(task):
+        group_stats.update(rowid, data, stats)
+    return group_stats
+
+def bugs_range(task):
+    return row_bugs(range_rows(task, "bugs"), task[2])
+
 
 def arch_str(gpu_info):
     if "architecture" in gpu_info:
@@ -268,54 +838,74 @@ def device_str(gpu_info):
     else:
         return gpu_info["vendor"]
 
-def analyze(cursor, group_by, vendor, is_legacy, mobile):
-    results = {}
-    for row in run_query(cursor, vendor, is_legacy, mobile):
-        data = json.loads(row[1])
-        stats = stats_per_test(data, is_legacy)
-        if group_by == "indiv":
-            # Every row gets its own total
-            init_group_by(results, row[0], is_legacy)
-            update_group_by(results, row[0], row[0], data, stats, is_legacy)
-        elif group_by == "vendor":
-            # Group by vendor
-            vendor = data["platformInfo"]["gpu"]["vendor"]
-            if vendor not in results:
-                init_group_by(results, vendor, is_legacy)
-            update_group_by(results, vendor, row[0], data, stats, is_legacy)
-        elif group_by == "all":
-            if "all" not in results:
-                init_group_by(results, "all", is_legacy)
-            update_group_by(results, "all", row[0], data, stats, is_legacy)
-    for key in results:
-        results[key]["avgRates"] = {}
-        results[key]["medianRates"] = {}
-        # Get the median and average rates per test
-        for test in results[key]["rates"]:
-            results[key]["avgRates"][test] = sum(results[key]["rates"][test])/results[key]["total"]
-            results[key]["medianRates"][test] = median(results[key]["rates"][test])
-    return results
+def group_rows(rows, group_by, is_legacy, quantiles="exact"):
+    group_stats = GroupStats(group_by, is_legacy, quantiles)
+    timer = profiler.timer()
+    for rowid, data, stats in rows:
+        timer.restart()
+        group_stats.update(rowid, data, stats)
+        timer.lap("group")
+    return group_stats.finish()
 
-def analyze_rowid(cursor, rowid, is_legacy):
+def analyze(cursor, group_by, vendor, is_legacy, mobile, engine="json", cache=False, jobs=1, filters=None, quantiles="exact"):
+    if jobs > 1:
+        group_stats = GroupStats(group_by, is_legacy, quantiles)
+        # The phases of the worker processes aren't profiled, only the time spent waiting for them
+        with profiler.phase("workers"):
+            partials = map_ranges(cursor, group_range, vendor, is_legacy, mobile, engine, cache, jobs, (group_by, quantiles), filters)
+        for partial in partials:
+            group_stats.merge(partial)
+        return group_stats.finish()
+    return group_rows(row_stats(cursor, vendor, is_legacy, mobile, engine, cache, filters=filters), group_by, is_legacy, quantiles)
+
+def analyze_rowid(cursor, rowid, is_legacy, engine="json", cache=False):
+    if cursor.execute("select 1 from tuning_results where rowid = ?", [rowid]).fetchone() is None:
+        raise SystemExit("No result with rowid {}".format(rowid))
+    if cache:
+        check_stats_cache(cursor)
+        query = """
+            select c.stats, c.platform_info from stats_cache c join tuning_results t on t.rowid = c.result_id
+            where c.result_id = ? and c.legacy = ? and c.version = ? and c.results_hash = t.content_hash"""
+        res = cursor.execute(query, [rowid, is_legacy, stats_version(engine)]).fetchone()
+        if res:
+            stats = json.loads(res[0])
+            stats["platformInfo"] = json.loads(res[1])
+            return stats
+        stats = analyze_rowid(cursor, rowid, is_legacy, engine)
+        platform_info = stats.pop("platformInfo")
+        results_hash = cursor.execute("select content_hash from tuning_results where rowid = ?", [rowid]).fetchone()[0]
+        if results_hash is not None:
+            cursor.execute("insert or replace into stats_cache values (?, ?, ?, ?, ?, ?)",
+                           [rowid, is_legacy, results_hash, stats_version(engine), json.dumps(stats), json.dumps(platform_info)])
+            cursor.connection.commit()
+        stats["platformInfo"] = platform_info
+        return stats
+    if engine == "sql":
+        cursor.execute("select json_extract({}, '$.platformInfo') from tuning_results where rowid = ?".format(results_json_sql), [rowid])
+        platform_info = json.loads(cursor.fetchone()[0])
+        stats = stats_sql(cursor, "?", [rowid], is_legacy)[rowid]
+        stats["platformInfo"] = platform_info
+        return stats
     cursor.execute("select results from tuning_results where rowid = ?", [rowid])
     res = cursor.fetchone()
-    data = json.loads(res[0])
-    stats = stats_per_test(data, is_legacy)
+    data = decode_results(res[0], skip_params=True)
+    stats = compute_stats(data, is_legacy, engine)
     stats["platformInfo"] = data["platformInfo"]
     return stats
 
-def find_bugs(cursor, vendor, is_legacy, mobile):
+def row_bugs(rows, is_legacy):
     bugs = {}
-    for row in run_query(cursor, vendor, is_legacy ,mobile):
-        data = json.loads(row[1])
-        stats = stats_per_test(data, is_legacy)
+    for rowid, data, stats in rows:
         if stats["bugs"]:
-            bugs[row[0]] = {
+            bugs[rowid] = {
                 "bugs": stats["bugs"],
                 "device": device_str(data["platformInfo"]["gpu"])
             }
             if not is_legacy:
-                bugs[row[0]]["platform"] = data["platformInfo"]["os"]["vendor"]
+                bugs[rowid]["platform"] = data["platformInfo"]["os"]["vendor"]
+    return bugs
+
+def bug_totals(bugs, is_legacy):
     totals = {}
     if not is_legacy:
         totals = {}
@@ -330,49 +920,676 @@ def find_bugs(cursor, vendor, is_legacy, mobile):
         "totals": totals
     }
 
-def similarity(cursor, vendor, mobile):
-    data_file = open("temp.csv", 'w')
-    csv_writer = csv.writer(data_file)
+def collect_bugs(rows, is_legacy):
+    return bug_totals(row_bugs(rows, is_legacy), is_legacy)
+
+def find_bugs(cursor, vendor, is_legacy, mobile, engine="json", cache=False, jobs=1, filters=None):
+    if jobs > 1:
+        bugs = {}
+        with profiler.phase("workers"):
+            partials = map_ranges(cursor, bugs_range, vendor, is_legacy, mobile, engine, cache, jobs, filters=filters)
+        for partial in partials:
+            bugs.update(partial)
+        return bug_totals(bugs, is_legacy)
+    return collect_bugs(row_stats(cursor, vendor, is_legacy, mobile, engine, cache, filters=filters, fields="bugs"), is_legacy)
+
+def state_key(analysis, vendor, is_legacy, mobile, filters):
+    return json.dumps([analysis, vendor, is_legacy, mobile, filters, stats_version()])
+
+# Drops the stored analyses of other versions of the statistics code, which are never loaded again, and the rollup
+# and best_params rows of every dropped state, including those the triggers dropped
+def prune_states(cursor):
+    version = stats_version()
+    stale = [[key] for key, in cursor.execute("select key from analysis_state").fetchall() if json.loads(key)[-1] != version]
+    cursor.executemany("delete from analysis_state where key = ?", stale)
+    for table, in cursor.execute("select name from sqlite_master where type = 'table' and name in ('rollup', 'best_params')").fetchall():
+        cursor.execute("delete from {} where cube not in (select key from analysis_state)".format(table))
+
+# Returns the stored state of an incremental analysis, or None if it has to be rebuilt, and the range of rowids
+# still to be processed
+def load_state(cursor, key):
+    if not cursor.execute("select 1 from sqlite_master where type = 'table' and name = 'analysis_state'").fetchone():
+        raise SystemExit("Database has no analysis_state table, run insert.py --migrate first")
+    prune_states(cursor)
+    min_rowid, max_rowid = cursor.execute("select coalesce(min(rowid), 0), coalesce(max(rowid), 0) from tuning_results").fetchone()
+    res = cursor.execute("select watermark, row_count, state from analysis_state where key = ?", [key]).fetchone()
+    if res:
+        # Catches rows deleted or inserted below the watermark without the triggers, e.g. by older versions
+        row_count = cursor.execute("select count(*) from tuning_results where rowid <= ?", [res[0]]).fetchone()[0]
+        if row_count == res[1]:
+            return res[2], (res[0] + 1, max_rowid)
+    return None, (min_rowid, max_rowid)
+
+def save_state(cursor, key, watermark, state):
+    row_count = cursor.execute("select count(*) from tuning_results where rowid <= ?", [watermark]).fetchone()[0]
+    cursor.execute("insert or replace into analysis_state values (?, ?, ?, ?)", [key, watermark, row_count, state])
+    cursor.connection.commit()
+
+# Like analyze(), but only processes the rows added since the last incremental run and merges them into the stored groups
+def incremental_analyze(cursor, group_by, vendor, is_legacy, mobile, engine="json", cache=False, filters=None, quantiles="exact"):
+    key = state_key(["analyze", group_by, quantiles], vendor, is_legacy, mobile, filters)
+    state, rowids = load_state(cursor, key)
+    group_stats = GroupStats(group_by, is_legacy, quantiles)
+    if state:
+        group_stats.loads(state)
+    new_stats = GroupStats(group_by, is_legacy, quantiles)
+    for rowid, data, stats in row_stats(cursor, vendor, is_legacy, mobile, engine, cache, rowids, filters):
+        new_stats.update(rowid, data, stats)
+    group_stats.merge(new_stats)
+    save_state(cursor, key, rowids[1], group_stats.dumps())
+    return group_stats.finish()
+
+def incremental_bugs(cursor, vendor, is_legacy, mobile, engine="json", cache=False, filters=None):
+    key = state_key(["bugs"], vendor, is_legacy, mobile, filters)
+    state, rowids = load_state(cursor, key)
+    bugs = {}
+    if state:
+        bugs = dict(json.loads(state))
+    bugs.update(row_bugs(row_stats(cursor, vendor, is_legacy, mobile, engine, cache, rowids, filters, "bugs"), is_legacy))
+    save_state(cursor, key, rowids[1], json.dumps(list(bugs.items())))
+    return bug_totals(bugs, is_legacy)
+
+# Yields (test, rate, iteration, params) for every test of every tuning iteration that showed weak behaviors
+def iteration_rates(data):
+    for key in data:
+        # Conformance iterations only contain one test and the params
+        if iter_p.match(key) and len(data[key].keys()) > 2:
+            for test_key in data[key]:
+                if test_key != "params" and data[key][test_key]["weak"] > 0:
+                    rate = data[key][test_key]["weak"] / total_behaviors(data[key][test_key])
+                    yield test_key, rate, key, data[key].get("params", {})
+
+# Higher rates first, ties keep the earlier row and iteration, like stats_per_test
+def config_order(config):
+    return -config["rate"], config["rowid"], int(config["iteration"])
+
+# Adds the rows inserted since the last update to the best_params table, keeping the top configurations of each test
+def update_best_params(cursor, is_legacy, top=5):
+    if "cube" not in [row[1] for row in cursor.execute("pragma table_info(best_params)")]:
+        raise SystemExit("Database has no best_params table, run insert.py --migrate first")
+    key = state_key(["best_params", top], None, is_legacy, True, None)
+    state, rowids = load_state(cursor, key)
+    if not state:
+        cursor.execute("delete from best_params where cube = ?", [key])
+    configs = {}
+    timer = profiler.timer()
+    for rowid, results in run_query(cursor, None, is_legacy, True, "results", rowids):
+        timer.lap("fetch")
+        data = decode_results(results)
+        timer.lap("decode", 1, len(results))
+        gpu_info = data["platformInfo"]["gpu"]
+        device = (gpu_info["vendor"], gpu_info.get("architecture", ""), gpu_info.get("description", ""))
+        for test, rate, iteration, params in iteration_rates(data):
+            config = {"rate": rate, "rowid": rowid, "iteration": iteration, "params": params}
+            for level in [device, (device[0], device[1], None), (device[0], None, None)]:
+                level_configs = configs.setdefault(level + (test,), [])
+                level_configs.append(config)
+                if len(level_configs) > 4 * top:
+                    level_configs.sort(key=config_order)
+                    del level_configs[top:]
+        timer.lap("best_params")
+    level_filter = "cube = ? and vendor is ? and architecture is ? and description is ? and test = ?"
+    for level in configs:
+        for rate, rowid, iteration, params in cursor.execute("select rate, result_id, iteration, params from best_params where " + level_filter, (key,) + level).fetchall():
+            configs[level].append({"rate": rate, "rowid": rowid, "iteration": iteration, "params": json.loads(params)})
+        configs[level].sort(key=config_order)
+        cursor.execute("delete from best_params where " + level_filter, (key,) + level)
+        cursor.executemany("insert into best_params values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", [
+            (key,) + level + (rank, config["rate"], config["rowid"], config["iteration"], json.dumps(config["params"]))
+            for rank, config in enumerate(configs[level][:top])])
+    save_state(cursor, key, rowids[1], json.dumps({"top": top}))
+    return key
+
+def best_params_rows(cursor, cube, vendor, architecture, description, test=None):
+    query = "select test, rate, result_id, iteration, params from best_params where cube = ? and vendor is ? and architecture is ? and description is ?"
+    values = [cube, vendor, architecture, description]
+    if test:
+        query += " and test = ?"
+        values.append(test)
+    tests = {}
+    for test_key, rate, rowid, iteration, params in cursor.execute(query + " order by test, rank", values):
+        tests.setdefault(test_key, []).append({"rate": rate, "rowid": rowid, "iteration": iteration, "params": json.loads(params)})
+    return tests
+
+# The best configurations of a device. Devices that haven't been tuned get those of their architecture, or vendor.
+def best_params(cursor, cube, vendor, architecture=None, description=None, test=None):
+    levels = [("vendor", vendor, None, None)]
+    if architecture is not None:
+        levels.insert(0, ("architecture", vendor, architecture, None))
+        if description is not None:
+            levels.insert(0, ("device", vendor, architecture, description))
+    for level, *device in levels:
+        tests = best_params_rows(cursor, cube, *device, test)
+        if tests:
+            return {"level": level, "tests": tests}
+    return {"level": None, "tests": {}}
+
+# The whole index, nested by vendor, architecture and description ("*" for all of them)
+def best_params_index(cursor, cube):
+    index = {}
+    query = """select vendor, architecture, description, test, rate, result_id, iteration, params from best_params
+        where cube = ? order by vendor, architecture, description, test, rank"""
+    for vendor, architecture, description, test, rate, rowid, iteration, params in cursor.execute(query, [cube]):
+        tests = index.setdefault(vendor, {}).setdefault("*" if architecture is None else architecture, {})
+        tests = tests.setdefault("*" if description is None else description, {})
+        tests.setdefault(test, []).append({"rate": rate, "rowid": rowid, "iteration": iteration, "params": json.loads(params)})
+    return index
+
+rollup_levels = ["all", "vendor", "arch", "device"]
+
+# The (level, group key, split) of every group a row counts towards
+def rollup_cells(data, is_legacy):
+    gpu_info = data["platformInfo"]["gpu"]
+    groups = [("all", "all"), ("vendor", gpu_info["vendor"]), ("arch", arch_str(gpu_info)), ("device", device_str(gpu_info))]
+    splits = [""]
+    if not is_legacy:
+        splits.append("os:" + (data["platformInfo"]["os"]["vendor"] or "unknown"))
+        splits.append("browser:" + (data["platformInfo"].get("browser", {}).get("vendor") or "unknown"))
+    return [(level, key, split) for level, key in groups for split in splits]
+
+def rollup_key(is_legacy, mobile, filters):
+    return state_key(["rollup"], None, is_legacy, mobile, {"include_invalid": bool(filters and filters.get("include_invalid"))})
+
+# Adds the rows inserted since the last update to every group of the rollup in one pass, returning its cube. Groups
+# keep sketches of their rates and times, so a refresh costs the same however many rows they already cover.
+def update_rollup(cursor, is_legacy, mobile, engine="json", cache=False, filters=None):
+    if not cursor.execute("select 1 from sqlite_master where type = 'table' and name = 'rollup'").fetchone():
+        raise SystemExit("Database has no rollup table, run insert.py --migrate first")
+    key = rollup_key(is_legacy, mobile, filters)
+    state, rowids = load_state(cursor, key)
+    if not state:
+        cursor.execute("delete from rollup where cube = ?", [key])
+    # Cubes of the same rows under an older key, e.g. of older statistics code, are never read again
+    for cube, in cursor.execute("select distinct cube from rollup where cube != ?", [key]).fetchall():
+        if json.loads(cube)[2:5] == json.loads(key)[2:5]:
+            cursor.execute("delete from rollup where cube = ?", [cube])
+            cursor.execute("delete from analysis_state where key = ?", [cube])
+    include_invalid = {"include_invalid": True} if filters and filters.get("include_invalid") else None
+    cells = {}
+    timer = profiler.timer()
+    for rowid, data, stats in row_stats(cursor, None, is_legacy, mobile, engine, cache, rowids, include_invalid):
+        timer.restart()
+        for level, group_key, split in rollup_cells(data, is_legacy):
+            if (level, group_key, split) not in cells:
+                group_stats = GroupStats(level, is_legacy, "sketch")
+                init_group_by(group_stats.results, group_key, is_legacy, "sketch")
+                cells[(level, group_key, split)] = (data["platformInfo"]["gpu"]["vendor"], rowid, group_stats)
+            update_group_by(cells[(level, group_key, split)][2].results, group_key, rowid, data, stats, is_legacy)
+        timer.lap("rollup")
+    query = "select first_rowid, state from rollup where cube = ? and level = ? and group_key = ? and split = ?"
+    for (level, group_key, split), (vendor, first_rowid, group_stats) in cells.items():
+        stored = cursor.execute(query, [key, level, group_key, split]).fetchone()
+        if stored:
+            # The stored rows come first, so ties of the min and max rates keep the earlier row, as in a single pass
+            first_rowid = stored[0]
+            group_stats = GroupStats(level, is_legacy, "sketch").loads(stored[1]).merge(group_stats)
+        cursor.execute("insert or replace into rollup values (?, ?, ?, ?, ?, ?, ?)",
+                       [key, level, vendor, group_key, split, first_rowid, group_stats.dumps()])
+    save_state(cursor, key, rowids[1], json.dumps({"levels": rollup_levels}))
+    return key
+
+# Answers analyze() with the groups of the rollup, after refreshing it. With split ("os" or "browser") every
+# group is split further, e.g. {"intel gen-9": {"Windows": {...}, "macOS": {...}}}.
+def rollup_analyze(cursor, group_by, vendor, is_legacy, mobile, engine="json", cache=False, filters=None, split=None):
+    if group_by not in rollup_levels:
+        raise SystemExit("The rollup has no {} grouping, only {}".format(group_by, ", ".join(rollup_levels)))
+    if filters and any(filters.get(name) is not None for name in filter_columns):
+        raise SystemExit("The rollup can only be narrowed down with --vendor")
+    if split and is_legacy:
+        raise SystemExit("Legacy results have no os or browser to split groups by")
+    key = update_rollup(cursor, is_legacy, mobile, engine, cache, filters)
+    # The group of a vendor stands in for all of its rows
+    level = "vendor" if vendor and group_by == "all" else group_by
+    query = "select group_key, split, state from rollup where cube = ? and level = ?"
+    values = [key, level]
+    if vendor:
+        query += " and vendor = ?"
+        values.append(vendor)
+    if split:
+        query += " and split glob ?"
+        values.append(split + ":*")
+    else:
+        query += " and split = ''"
+    results = {}
+    for group_key, group_split, state in cursor.execute(query + " order by first_rowid", values).fetchall():
+        group = GroupStats(group_by, is_legacy, "sketch").loads(state).finish()[group_key]
+        if split:
+            results.setdefault(group_key, {})[group_split[len(split) + 1:]] = group
+        else:
+            results["all" if group_by == "all" else group_key] = group
+    return results
+
+def similarity_features(data):
+    features = []
+    for key in data:
+        # Only match keys that are iteration numbers, and are tuning runs
+        if iter_p.match(key) and len(data[key].keys()) > 2:
+            for test_key in all_tuning_tests:
+                test_data = data[key][test_key]
+                features += [test_data["interleaved"], test_data["weak"]]
+    return features
+
+def similarity_features_sql(cursor, rowid):
+    iterations = {}
+    query = "select iteration, test, interleaved, weak from test_results where result_id = ? and tuning = 1 order by position"
+    for row in cursor.execute(query, [rowid]):
+        if row[0] not in iterations:
+            iterations[row[0]] = {}
+        iterations[row[0]][row[1]] = row[2:]
+    features = []
+    for iteration in iterations.values():
+        for test_key in all_tuning_tests:
+            features += iteration[test_key]
+    return features
+
+def row_features(cursor, rowid, engine):
+    if engine == "sql":
+        return similarity_features_sql(cursor, rowid)
+    cursor.execute("select results from tuning_results where rowid = ?", [rowid])
+    return similarity_features(decode_results(cursor.fetchone()[0], skip_params=True))
+
+# Yields (gpu_info, features) for every matching row
+def similarity_rows(cursor, vendor, mobile, engine, filters=None):
+    for rowid, gpu_info, features in feature_rows(cursor, vendor, mobile, engine, filters):
+        yield gpu_info, features
+
+# Yields (rowid, gpu_info, features) for every matching row
+def feature_rows(cursor, vendor, mobile, engine, filters=None):
+    if engine == "sql":
+        if not has_shredded(cursor):
+            raise SystemExit("Database has no test_results table, run insert.py --migrate first")
+        features_cursor = cursor.connection.cursor()
+        timer = profiler.timer()
+        rows = run_query(cursor, vendor, False, mobile, "json_extract({}, '$.platformInfo.gpu')".format(results_json_sql), filters=filters).fetchall()
+        timer.lap("fetch", len(rows))
+        for row in rows:
+            gpu_info = json.loads(row[1])
+            timer.lap("decode", 1, len(row[1]))
+            features = similarity_features_sql(features_cursor, row[0])
+            timer.lap("features")
+            yield row[0], gpu_info, features
+            timer.restart()
+    else:
+        timer = profiler.timer()
+        for row in run_query(cursor, vendor, False, mobile, filters=filters):
+            timer.lap("fetch")
+            data = decode_results(row[1], skip_params=True)
+            timer.lap("decode", 1, len(row[1]))
+            features = similarity_features(data)
+            timer.lap("features")
+            yield row[0], data["platformInfo"]["gpu"], features
+            timer.restart()
+
+# Fills a float32 matrix with one row of features per device. Counts stay exact up to 2^24.
+def feature_matrix(devices, count=None):
+    import numpy as np
+    labels = []
     vendor_indices = []
-    for row in run_query(cursor, vendor, False, mobile):
-        data = json.loads(row[1])
-        csv_data = [device_str(data["platformInfo"]["gpu"])]
-        vendor_indices.append(data["platformInfo"]["gpu"]["vendor"])
-        for key in data:
-            # Only match keys that are iteration numbers, and are tuning runs
-            if iter_p.match(key) and len(data[key].keys()) > 2:
-                for test_key in all_tuning_tests:
-                    test_data = data[key][test_key]
-                    csv_data += [test_data["interleaved"], test_data["weak"]]
-        csv_writer.writerow(csv_data)
-    data_file.close()
-    df = pandas.read_csv("temp.csv", header=None, index_col = 0)
-    remove("temp.csv")
-
-    similarity = pandas.DataFrame(cosine_similarity(df))
-    similarity.index = df.index
-    similarity.columns = df.index
-
-    all_sims = []
-    for i in range(len(similarity.values)):
-        for j in range(i):
-            all_sims.append(similarity.values[i][j])
+    matrix = None
+    for gpu_info, features in devices:
+        if matrix is None:
+            matrix = np.empty((count or 64, len(features)), dtype=np.float32)
+        elif len(labels) == len(matrix):
+            matrix = np.concatenate([matrix, np.empty_like(matrix)])
+        if len(features) != matrix.shape[1]:
+            raise ValueError("{} has {} features, expected {}".format(device_str(gpu_info), len(features), matrix.shape[1]))
+        matrix[len(labels)] = features
+        if "source" in gpu_info:
+            labels.append(gpu_info["source"] + " " + device_str(gpu_info))
+        else:
+            labels.append(device_str(gpu_info))
+        vendor_indices.append(gpu_info["vendor"])
+    return labels, vendor_indices, matrix[:len(labels)]
+
+def similarity_result(labels, vendor_indices, sim):
+    import numpy as np
+    import pandas
+    # Every pair of devices once, i.e. the triangle below the diagonal
+    pairs = sim[np.tril_indices(len(sim), -1)].astype(np.float64)
+    index = pandas.Index(labels, name="device")
     return {
-        "similarity": similarity,
+        "similarity": pandas.DataFrame(sim, index=index, columns=index),
         "vendor_indices": vendor_indices,
-        "avg": sum(all_sims)/len(all_sims),
-        "median": median(all_sims),
-        "max": max(all_sims),
-        "min": min(all_sims)
+        "avg": float(pairs.mean()),
+        "median": float(np.median(pairs)),
+        "max": float(pairs.max()),
+        "min": float(pairs.min())
     }
 
-def kmeans(similarity, num_clusters):
-    sim_df = similarity["similarity"]
+def similarity_matrix(devices, count=None):
+    from sklearn.metrics.pairwise import cosine_similarity
+    labels, vendor_indices, matrix = feature_matrix(devices, count)
+    with profiler.phase("similarity", len(labels)):
+        return similarity_result(labels, vendor_indices, cosine_similarity(matrix))
+
+# Cosine similarity of two devices doesn't depend on the others, so a vendor's matrix is a slice of the full one
+def vendor_similarity(similarity, vendor):
+    import numpy as np
+    indices = [i for i in range(len(similarity["vendor_indices"])) if similarity["vendor_indices"][i] == vendor]
+    sim = similarity["similarity"].values[np.ix_(indices, indices)]
+    labels = [similarity["similarity"].index[i] for i in indices]
+    return similarity_result(labels, [vendor] * len(indices), sim)
+
+def similarity(cursor, vendor, mobile, engine="json", filters=None):
+    return similarity_matrix(similarity_rows(cursor, vendor, mobile, engine, filters))
+
+# Bins of the histogram the median similarity is read from, so it is within 2 / similarity_bins of the exact one
+similarity_bins = 65536
+
+# The feature matrix with every row scaled to unit length, so cosine similarities are dot products. With path
+# set, the matrix is stored in path.npy (and its labels in path.json) and reused while the rows are unchanged.
+def normalized_features(cursor, vendor, mobile, engine="json", filters=None, path=None):
+    import numpy as np
+    key = None
+    if path:
+        # Hashing the stored results is much cheaper than decoding them, and needs no extra columns
+        key = hashlib.sha1(json.dumps([vendor, mobile, filters]).encode())
+        for rowid, results in run_query(cursor, vendor, False, mobile, "results", filters=filters):
+            key.update(str(rowid).encode())
+            key.update(results.encode() if isinstance(results, str) else results)
+        key = key.hexdigest()
+        if os.path.exists(path + ".json"):
+            with open(path + ".json") as meta_file:
+                meta = json.load(meta_file)
+            if meta["key"] == key:
+                return np.load(path + ".npy", mmap_mode="r"), meta
+    rowids = []
+    devices = []
+    for rowid, gpu_info, features in feature_rows(cursor, vendor, mobile, engine, filters):
+        rowids.append(rowid)
+        devices.append((gpu_info, features))
+    if not devices:
+        raise SystemExit("No results to compare")
+    labels, vendor_indices, matrix = feature_matrix(devices, len(devices))
+    with profiler.phase("normalize", len(matrix)):
+        norms = np.linalg.norm(matrix, axis=1)
+        # Devices without weak or interleaved behaviors stay zero, i.e. similarity 0 to every other device
+        matrix /= np.where(norms == 0, 1, norms)[:, None]
+    meta = {"key": key, "rowids": rowids, "labels": labels, "vendors": vendor_indices}
+    if path:
+        np.save(path + ".npy", matrix)
+        with open(path + ".json", "w") as meta_file:
+            json.dump(meta, meta_file)
+    return matrix, meta
+
+# Indices of the k most similar other devices of each row of a block, most similar first. Ties go to the lower index.
+def top_k(block, rows, k):
+    import numpy as np
+    block[np.arange(len(rows)), rows] = -np.inf
+    k = min(k, block.shape[1] - 1)
+    if k <= 0:
+        order = np.zeros((len(rows), 0), dtype=np.int64)
+        return order, np.take_along_axis(block, order, axis=1)
+    # Only the k most similar are sorted: those above the k-th similarity, and the lowest indices equal to it
+    kth = -np.partition(-block, k - 1, axis=1)[:, k - 1:k]
+    ties = block == kth
+    needed = k - (block > kth).sum(axis=1, keepdims=True)
+    selected = (block > kth) | (ties & (np.cumsum(ties, axis=1) <= needed))
+    candidates = np.nonzero(selected)[1].reshape(len(rows), k)
+    order = np.take_along_axis(candidates, np.argsort(-np.take_along_axis(block, candidates, axis=1), axis=1, kind="stable"), axis=1)
+    return order, np.take_along_axis(block, order, axis=1)
+
+def neighbour_list(meta, order, values):
+    return [{
+        "rowid": meta["rowids"][index],
+        "device": meta["labels"][index],
+        "similarity": float(value)
+    } for index, value in zip(order, values)]
+
+def nearest(matrix, meta, rowid, k):
+    import numpy as np
+    if rowid not in meta["rowids"]:
+        raise SystemExit("Result {} isn't one of the devices compared, is it a mobile result?".format(rowid))
+    index = meta["rowids"].index(rowid)
+    block = (matrix[index] @ np.asarray(matrix).T)[None, :]
+    order, values = top_k(block, np.array([index]), k)
+    return {
+        "rowid": rowid,
+        "device": meta["labels"][index],
+        "nearest": neighbour_list(meta, order[0], values[0])
+    }
+
+# The k nearest neighbours of every device, and the same summary statistics as similarity(), computed in blocks of
+# rows so memory grows with block_size times the number of devices instead of its square
+def blocked_similarity(matrix, meta, k, block_size=1024):
+    import numpy as np
+    count = len(matrix)
+    neighbours = []
+    total = 0
+    pairs = 0
+    low = np.inf
+    high = -np.inf
+    histogram = np.zeros(similarity_bins, dtype=np.int64)
+    timer = profiler.timer()
+    for start in range(0, count, block_size):
+        rows = np.arange(start, min(start + block_size, count))
+        block = np.asarray(matrix[rows]) @ np.asarray(matrix).T
+        # Every pair of devices once, i.e. the triangle below the diagonal
+        below = block[np.arange(count)[None, :] < rows[:, None]].astype(np.float64)
+        if len(below):
+            total += below.sum()
+            pairs += len(below)
+            low = min(low, below.min())
+            high = max(high, below.max())
+            # Rounding can put cosine similarities just outside [-1, 1], which np.histogram would leave out
+            histogram += np.histogram(np.clip(below, -1, 1), bins=similarity_bins, range=(-1, 1))[0]
+        order, values = top_k(block, rows, k)
+        for row in range(len(rows)):
+            neighbours.append({
+                "rowid": meta["rowids"][rows[row]],
+                "device": meta["labels"][rows[row]],
+                "nearest": neighbour_list(meta, order[row], values[row])
+            })
+        timer.lap("similarity", len(rows))
+    if not pairs:
+        raise SystemExit("At least two devices are needed to compare them")
+    # The median averages the two middle pairs (the same one for an odd count), each placed within its bin as if the
+    # similarities in it were evenly spread
+    cumulative = np.cumsum(histogram)
+    middle = []
+    for rank in [(pairs - 1) // 2, pairs // 2]:
+        index = np.searchsorted(cumulative, rank + 1)
+        before = cumulative[index] - histogram[index]
+        middle.append(-1 + (index + (rank - before + 0.5) / histogram[index]) * 2 / similarity_bins)
+    return {
+        "neighbours": neighbours,
+        "devices": count,
+        "avg": float(total / pairs),
+        "median": float((middle[0] + middle[1]) / 2),
+        "max": float(high),
+        "min": float(low)
+    }
+
+def nearest_csv(similarity, path):
+    import pandas
+    rows = []
+    for device in similarity["neighbours"]:
+        for rank, neighbour in enumerate(device["nearest"]):
+            rows.append([device["rowid"], device["device"], rank + 1, neighbour["rowid"], neighbour["device"], neighbour["similarity"]])
+    columns = ["rowid", "device", "rank", "neighbour_rowid", "neighbour", "similarity"]
+    pandas.DataFrame(rows, columns=columns).to_csv(path, index=False)
+
+# Databases analyzed together, e.g. one per campaign. Legacy databases are told apart by their lack of an os column.
+def open_sources(db_paths):
+    names = [os.path.splitext(os.path.basename(path))[0] for path in db_paths]
+    sources = []
+    for path, name in zip(db_paths, names):
+        if not os.path.isfile(path):
+            raise SystemExit("{} is not a database, export directories can't be analyzed together".format(path))
+        if names.count(name) > 1:
+            name = path
+        sources.append({"name": name, "path": path, "legacy": is_legacy_table(db_conn(path))})
+    return sources
+
+def layout_name(is_legacy):
+    return "legacy" if is_legacy else "webgpu"
+
+# Rows of a federated analysis are tagged with their database, so rowids of different databases don't collide
+def tag_rows(rows, source):
+    for rowid, data, stats in rows:
+        data["source"] = source
+        yield "{}:{}".format(source, rowid), data, stats
+
+def source_row_stats(task, fields="all"):
+    source, vendor, mobile, engine, cache, filters, arg = task
+    rows = row_stats(db_conn(source["path"]), vendor, source["legacy"], mobile, engine, cache, filters=filters, fields=fields)
+    return tag_rows(rows, source["name"])
+
+def source_groups(task):
+    group_by, quantiles = task[-1]
+    group_stats = GroupStats(group_by, task[0]["legacy"], quantiles)
+    for rowid, data, stats in source_row_stats(task):
+        group_stats.update(rowid, data, stats)
+    return group_stats
+
+def source_bugs(task):
+    return row_bugs(source_row_stats(task, "bugs"), task[0]["legacy"])
+
+# Runs worker over the databases, each in its own process if jobs is more than 1, returning the results in order
+def map_sources(worker, sources, vendor, mobile, engine, cache, jobs, arg=None, filters=None):
+    tasks = [(source, vendor, mobile, engine, cache, filters, arg) for source in sources]
+    if jobs > 1 and len(tasks) > 1:
+        from multiprocessing import Pool
+        with profiler.phase("workers"):
+            with Pool(min(jobs, len(tasks))) as pool:
+                return pool.map(worker, tasks)
+    return [worker(task) for task in tasks]
+
+# Results of several databases, the groups of legacy and WebGPU databases kept apart since they run different tests
+def federated_analyze(sources, group_by, vendor, mobile, engine="json", cache=False, jobs=1, filters=None, quantiles="exact"):
+    groups = {}
+    partials = map_sources(source_groups, sources, vendor, mobile, engine, cache, jobs, (group_by, quantiles), filters)
+    for source, partial in zip(sources, partials):
+        layout = layout_name(source["legacy"])
+        if layout not in groups:
+            groups[layout] = partial
+        else:
+            groups[layout].merge(partial)
+    results = {"sources": sources}
+    for layout in groups:
+        results[layout] = groups[layout].finish()
+    return results
+
+def federated_bugs(sources, vendor, mobile, engine="json", cache=False, jobs=1, filters=None):
+    bugs = {}
+    partials = map_sources(source_bugs, sources, vendor, mobile, engine, cache, jobs, filters=filters)
+    for source, partial in zip(sources, partials):
+        bugs.setdefault(layout_name(source["legacy"]), {}).update(partial)
+    results = {"sources": sources}
+    for layout in bugs:
+        results[layout] = bug_totals(bugs[layout], layout == "legacy")
+    return results
+
+# Legacy results have no tuning tests, so only the WebGPU databases are compared
+def federated_similarity(sources, vendor, mobile, engine="json", filters=None):
+    devices = []
+    for source in sources:
+        if source["legacy"]:
+            continue
+        for gpu_info, features in similarity_rows(db_conn(source["path"]), vendor, mobile, engine, filters):
+            devices.append((dict(gpu_info, source=source["name"]), features))
+    if not devices:
+        raise SystemExit("None of the databases has WebGPU results to compare")
+    return similarity_matrix(devices, len(devices))
+
+class Session:
+    # Loads a database once, so every analysis of it only decodes each row a single time
+    def __init__(self, cursor, is_legacy, mobile=False, engine="json", cache=False):
+        self.cursor = cursor
+        self.is_legacy = is_legacy
+        self.engine = engine
+        self.rows = []
+        self.features = {}
+        self.results = {}
+        self.all_similarity = None
+        # Only the json and numpy engines have the iterations at hand, otherwise features are loaded on first use
+        keep_features = not is_legacy and engine != "sql" and not cache
+        if keep_features:
+            import numpy as np
+        timer = profiler.timer()
+        for rowid, data, stats in row_stats(cursor, None, is_legacy, mobile, engine, cache):
+            if keep_features:
+                timer.restart()
+                self.features[rowid] = np.array(similarity_features(data), dtype=np.float32)
+                timer.lap("features")
+            self.rows.append((rowid, {"platformInfo": data["platformInfo"]}, stats))
+
+    def vendor_rows(self, vendor):
+        if not vendor:
+            return self.rows
+        return [row for row in self.rows if row[1]["platformInfo"]["gpu"]["vendor"] == vendor]
+
+    def analyze(self, group_by, vendor=None):
+        if (group_by, vendor) not in self.results:
+            self.results[(group_by, vendor)] = group_rows(self.vendor_rows(vendor), group_by, self.is_legacy)
+        return self.results[(group_by, vendor)]
+
+    def find_bugs(self, vendor=None):
+        return collect_bugs(self.vendor_rows(vendor), self.is_legacy)
+
+    def similarity(self, vendor=None):
+        import numpy as np
+        # The similarity of all devices is computed once, vendors are slices of it
+        if self.all_similarity is None:
+            devices = []
+            timer = profiler.timer()
+            for rowid, data, stats in self.rows:
+                if rowid not in self.features:
+                    timer.restart()
+                    self.features[rowid] = np.array(row_features(self.cursor, rowid, self.engine), dtype=np.float32)
+                    timer.lap("features")
+                devices.append((data["platformInfo"]["gpu"], self.features[rowid]))
+            self.all_similarity = similarity_matrix(devices, len(devices))
+        if not vendor:
+            return self.all_similarity
+        return vendor_similarity(self.all_similarity, vendor)
+
+# Fitted clusterings by (similarity matrix, number of clusters, mode, seed), least recently used first. Only the
+# last kmeans_cache_size are kept, so long running processes like serve.py don't grow without bound.
+kmeans_cache = OrderedDict()
+kmeans_cache_size = 32
+
+def matrix_key(matrix):
+    import numpy as np
+    return hashlib.sha1(np.ascontiguousarray(matrix).tobytes()).hexdigest() + str(matrix.shape)
+
+# exact clusters the full similarity matrix. minibatch uses MiniBatchKMeans and pca clusters the rows
+# projected onto their first 32 principal components, both meant for thousands of devices.
+def fit_kmeans(matrix, num_clusters, mode="exact", seed=42):
+    from sklearn.cluster import KMeans, MiniBatchKMeans
+    from sklearn.decomposition import PCA
+    if mode == "minibatch":
+        model = MiniBatchKMeans(n_clusters=num_clusters, random_state=seed, n_init=3, batch_size=1024)
+    else:
+        model = KMeans(n_clusters=num_clusters, random_state=seed, n_init=10)
+    if mode == "pca":
+        matrix = PCA(n_components=min(32, *matrix.shape), random_state=seed).fit_transform(matrix)
+    model.fit(matrix)
+    return model.labels_, model.inertia_
+
+def cached_kmeans(matrix, cluster_counts, mode="exact", seed=42, jobs=None):
+    from joblib import Parallel, delayed
+    key = matrix_key(matrix)
+    missing = [k for k in cluster_counts if (key, k, mode, seed) not in kmeans_cache]
+    if len(missing) > 1:
+        # Fit the missing cluster counts in parallel
+        fits = Parallel(n_jobs=jobs or -1)(delayed(fit_kmeans)(matrix, k, mode, seed) for k in missing)
+    else:
+        fits = [fit_kmeans(matrix, k, mode, seed) for k in missing]
+    for k, fit in zip(missing, fits):
+        kmeans_cache[(key, k, mode, seed)] = fit
+    res = {}
+    for k in cluster_counts:
+        kmeans_cache.move_to_end((key, k, mode, seed))
+        res[k] = kmeans_cache[(key, k, mode, seed)]
+    while len(kmeans_cache) > kmeans_cache_size:
+        kmeans_cache.popitem(last=False)
+    return res
+
+def kmeans_result(similarity, labels, inertia):
     vendor_indices = similarity["vendor_indices"]
-    kmeans = KMeans(n_clusters=num_clusters, random_state=42, n_init=10).fit(sim_df)
     kmeans_res = {}
-    labels = kmeans.labels_
-    gpu_names = list(sim_df.index)
+    gpu_names = list(similarity["similarity"].index)
     for i in range(len(labels)):
         label = str(labels[i])
         if label not in kmeans_res:
@@ -384,65 +1601,296 @@ def kmeans(similarity, num_clusters):
             kmeans_res[label]["counts"][vendor_indices[i]] = 0
         kmeans_res[label]["counts"][vendor_indices[i]] += 1
         kmeans_res[label]["devices"].append(gpu_names[i])
-    kmeans_res["inertia"] = kmeans.inertia_
+    kmeans_res["inertia"] = inertia
     return kmeans_res
 
+# Fits every number of clusters (e.g. for an elbow plot), returning the results by number of clusters.
+# If mode isn't exact and agreement is set, each result also gets the adjusted Rand index
+# of its labels against the exact clustering.
+def kmeans_sweep(similarity, cluster_counts, mode="exact", agreement=False, jobs=None):
+    from sklearn.metrics import adjusted_rand_score
+    matrix = similarity["similarity"].values
+    with profiler.phase("kmeans", len(matrix)):
+        fits = cached_kmeans(matrix, cluster_counts, mode, jobs=jobs)
+    results = {}
+    for k in cluster_counts:
+        results[k] = kmeans_result(similarity, *fits[k])
+    if agreement and mode != "exact":
+        with profiler.phase("kmeans", len(matrix)):
+            exact_fits = cached_kmeans(matrix, cluster_counts, jobs=jobs)
+        for k in cluster_counts:
+            results[k]["agreement"] = adjusted_rand_score(exact_fits[k][0], fits[k][0])
+    return results
+
+def kmeans(similarity, num_clusters, mode="exact", agreement=False):
+    return kmeans_sweep(similarity, [num_clusters], mode, agreement)[num_clusters]
+
 def correlate(dataset):
-    data_file = open("temp.csv", 'w')
-    csv_writer = csv.writer(data_file)
-    first = True
+    import pandas
+    columns = None
+    rows = []
     for key in dataset:
         if iter_p.match(key):
-            row = []
-            if first:
-                for test_key in dataset[key]:
-                    if test_key != "params":
-                        row.append(test_key)
-                first = False
-                csv_writer.writerow(row)
-                row = []
-            for test_key in dataset[key]:
-                if test_key != "params":
-                    row.append(dataset[key][test_key]["weak"])
-            csv_writer.writerow(row)
-    data_file.close()
-    df = pandas.read_csv("temp.csv")
-    remove("temp.csv")
-    return df.corr()
+            tests = [test_key for test_key in dataset[key] if test_key != "params"]
+            if columns is None:
+                columns = tests
+            rows.append([dataset[key][test_key]["weak"] for test_key in tests])
+    with profiler.phase("corr", len(rows)):
+        # Conformance iterations run fewer tests, so their rows are padded with NaN
+        return pandas.DataFrame(rows, columns=columns).corr()
+
+# Arrays written by export.py, with their dtype and width. Entries are the tests of every iteration of
+# every result, and the offsets give the range of each result's entries, iterations and params.
+export_arrays = {
+    "result_ids": ("int64", None),
+    "entry_offsets": ("int64", None),
+    "iteration_offsets": ("int64", None),
+    "param_offsets": ("int64", None),
+    "test_codes": ("int32", None),
+    "iterations": ("int64", None),
+    "tuning": ("bool", None),
+    "counts": ("int64", 3),
+    "durations": ("float64", None),
+    "iteration_keys": ("int64", None),
+    "param_iterations": ("int64", None),
+    "param_codes": ("int32", None),
+    "param_values": ("float64", None)
+}
+
+# The values of a result the tuning_results columns hold, for filtering
+def device_filter_values(platform_info):
+    return {
+        "gpu_vendor": platform_info["gpu"]["vendor"],
+        "architecture": platform_info["gpu"].get("architecture", ""),
+        "description": platform_info["gpu"].get("description", ""),
+        "os": platform_info["os"]["vendor"] if "os" in platform_info else "",
+        "browser": platform_info["browser"]["vendor"] if "browser" in platform_info else "",
+        "framework": platform_info.get("framework", "")
+    }
+
+# The arrays are memory-mapped, so only the results being analyzed are read into memory
+def load_export(path):
+    import numpy as np
+    with open(os.path.join(path, "meta.json")) as meta_file:
+        meta = json.load(meta_file)
+    with open(os.path.join(path, "devices.json")) as devices_file:
+        devices = json.load(devices_file)
+    arrays = {}
+    for name in export_arrays:
+        arrays[name] = np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+    return {
+        "meta": meta,
+        "devices": devices,
+        "arrays": arrays
+    }
 
+# The same dict as flatten_dataset, for the index-th result of an export
+def export_flat(export, index):
+    arrays = export["arrays"]
+    entries = slice(arrays["entry_offsets"][index], arrays["entry_offsets"][index + 1])
+    iterations = slice(arrays["iteration_offsets"][index], arrays["iteration_offsets"][index + 1])
+    return {
+        "keys": [str(key) for key in arrays["iteration_keys"][iterations]],
+        "tests": export["meta"]["tests"],
+        "test_codes": arrays["test_codes"][entries],
+        "iterations": arrays["iterations"][entries],
+        "tuning": arrays["tuning"][entries],
+        "counts": arrays["counts"][entries],
+        "durations": arrays["durations"][entries]
+    }
+
+# Yields the index and device of every matching result, like run_query
+def export_rows(export, vendor, mobile, filters=None):
+    for index in range(len(export["devices"])):
+        device = export["devices"][index]
+        if vendor and device["gpu_vendor"] != vendor:
+            continue
+        if not mobile and not export["meta"]["legacy"] and device["os"] == "Android":
+            continue
+        if filters and any(filters.get(name) is not None and device[name] != filters[name] for name in filter_columns):
+            continue
+        if not device.get("valid", True) and not (filters and filters.get("include_invalid")):
+            continue
+        yield index, device
+
+def export_row_stats(export, vendor, mobile, filters=None):
+    for index, device in export_rows(export, vendor, mobile, filters):
+        yield device["rowid"], {"platformInfo": device["platformInfo"]}, flat_stats(export_flat(export, index), export["meta"]["legacy"])
+
+# Same features as similarity_features
+def flat_features(flat, tests):
+    import numpy as np
+    positions = np.full(len(tests), -1)
+    for i in range(len(all_tuning_tests)):
+        if all_tuning_tests[i] in tests:
+            positions[tests.index(all_tuning_tests[i])] = i
+    tuning = np.flatnonzero(flat["tuning"])
+    iterations = np.unique(flat["iterations"][tuning], return_inverse=True)[1]
+    features = np.zeros((iterations.max() + 1 if len(tuning) else 0, len(all_tuning_tests), 2), dtype=np.float32)
+    features[iterations, positions[flat["test_codes"][tuning]]] = flat["counts"][tuning, 1:]
+    return features.ravel()
+
+def export_similarity(export, vendor, mobile, filters=None):
+    devices = []
+    for index, device in export_rows(export, vendor, mobile, filters):
+        devices.append((device["platformInfo"]["gpu"], flat_features(export_flat(export, index), export["meta"]["tests"])))
+    return similarity_matrix(devices, len(devices))
+
+def export_index(export, rowid):
+    rowids = [device["rowid"] for device in export["devices"]]
+    if rowid not in rowids:
+        raise SystemExit("No result with rowid {}".format(rowid))
+    return rowids.index(rowid)
+
+# Same as correlate, for a result in an export
+def export_correlate(export, rowid):
+    import numpy as np
+    import pandas
+    flat = export_flat(export, export_index(export, rowid))
+    columns = [export["meta"]["tests"][code] for code in flat["test_codes"][flat["iterations"] == 0]]
+    # Conformance iterations run fewer tests, so their rows are padded with NaN
+    boundaries = np.flatnonzero(np.diff(flat["iterations"])) + 1
+    rows = [weak.tolist() for weak in np.split(flat["counts"][:, 2], boundaries)]
+    with profiler.phase("corr", len(rows)):
+        return pandas.DataFrame(rows, columns=columns).corr()
+
+# Flags that only work on a single database, as (attribute, flag)
+database_flags = [("checksum", "--checksum"), ("best_params", "--best-params"), ("nearest", "--nearest"), ("k", "--k"),
+                  ("features", "--features"), ("rollup", "--rollup"), ("split", "--split"), ("incremental", "--incremental")]
+
+def reject_flags(args, flags, reason):
+    given = [flag for name, flag in flags if getattr(args, name) not in [None, False]]
+    if given:
+        raise SystemExit("{} {}".format(", ".join(given), reason))
+
+def export_main(path, args, filters):
+    export = load_export(path)
+    is_legacy = export["meta"]["legacy"]
+    reject_flags(args, database_flags, "can't be used with an export directory")
+    if args.rowid:
+        index = export_index(export, int(args.rowid))
+        stats = flat_stats(export_flat(export, index), is_legacy)
+        stats["platformInfo"] = export["devices"][index]["platformInfo"]
+        print_json(stats)
+    elif args.bugs:
+        print_json(collect_bugs(export_row_stats(export, args.vendor, args.mobile, filters), is_legacy))
+    elif args.avg:
+        print_json(group_rows(export_row_stats(export, args.vendor, args.mobile, filters), args.avg, is_legacy, args.quantiles))
+    elif args.similarity:
+        export_similarity(export, args.vendor, args.mobile, filters)["similarity"].to_csv("similarity.csv")
+    elif args.kmeans:
+        print_json(kmeans(export_similarity(export, args.vendor, args.mobile, filters), int(args.kmeans), args.kmeans_mode, args.kmeans_agreement))
+    elif args.corr:
+        print(export_correlate(export, int(args.corr)))
+
+
+def federated_main(sources, args, filters):
+    reject_flags(args, [("rowid", "--rowid"), ("corr", "--corr")] + database_flags, "can only be used with a single database")
+    if args.bugs:
+        print_json(federated_bugs(sources, args.vendor, args.mobile, args.engine, args.cache, args.jobs, filters))
+    elif args.avg:
+        print_json(federated_analyze(sources, args.avg, args.vendor, args.mobile, args.engine, args.cache, args.jobs, filters, args.quantiles))
+    elif args.similarity:
+        res = federated_similarity(sources, args.vendor, args.mobile, args.engine, filters)
+        res["similarity"].to_csv("similarity.csv")
+    elif args.kmeans:
+        sim_res = federated_similarity(sources, args.vendor, args.mobile, args.engine, filters)
+        print_json(kmeans(sim_res, int(args.kmeans), args.kmeans_mode, args.kmeans_agreement))
 
 def print_json(value):
     print(json.dumps(value, indent=2))
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("db_path", help="Path to sqlite database")
+    parser.add_argument("db_path", nargs="+", help="Path to sqlite database, or a directory written by export.py. --avg, --bugs, --similarity and --kmeans can analyze several databases together.")
     parser.add_argument("--rowid", help="Specify a specific row to analyze")
     parser.add_argument("--bugs", action="store_true", help="Show all bugs found")
     parser.add_argument("--mobile", action="store_true", help="Analyze mobile results")
-    parser.add_argument("--checksum", action="store_true", help="Perform checksums when analyzing")
+    parser.add_argument("--checksum", action="store_true", help="List the results whose test instance counts don't match their params")
+    parser.add_argument("--include-invalid", action="store_true", help="Also analyze results that failed validation when they were inserted")
     parser.add_argument("--legacy", action="store_true", help="Analyzing legacy results requires some hacks")
-    parser.add_argument("--avg", help="Average weak behaviors by grouping. Options: indiv, vendor, arch, all")
+    parser.add_argument("--avg", help="Average weak behaviors by grouping. Options: indiv, vendor, arch, device, all, and source for several databases")
     parser.add_argument("--vendor", help="Only return results from this vendor")
+    parser.add_argument("--architecture", help="Only return results from this gpu architecture")
+    parser.add_argument("--description", help="Only return results from this gpu description")
+    parser.add_argument("--browser", help="Only return results from this browser")
+    parser.add_argument("--framework", help="Only return results from this framework")
     parser.add_argument("--similarity", action="store_true", help="Calculate similarity between datasets")
+    parser.add_argument("--nearest", type=int, help="Find the devices most similar to the result with this rowid")
+    parser.add_argument("--k", type=int, help="Number of neighbours of --nearest, or with --similarity, keep only this many neighbours per device in nearest.csv instead of writing the whole matrix")
+    parser.add_argument("--features", help="Store the normalized features of --nearest and --similarity --k at this path (.npy and .json) and reuse them while the results are unchanged")
+    parser.add_argument("--best-params", action="store_true", help="Update the index of the best stress parameters per device and test, and print the entries of --vendor (and --architecture, --description), or the whole index")
+    parser.add_argument("--test", help="Only print the best parameters of this test")
+    parser.add_argument("--top", type=int, default=5, help="Number of parameter configurations kept per device and test by --best-params")
     parser.add_argument("--kmeans", help="Calculate kmeans clusters")
-    parser.add_argument("--corr", help="Calculate the correlation between weak behaviors of the specified dataset")
+    parser.add_argument("--kmeans-mode", default="exact", choices=["exact", "minibatch", "pca"], help="Cluster the full similarity matrix (exact), with MiniBatchKMeans (minibatch) or on PCA projected rows (pca)")
+    parser.add_argument("--kmeans-agreement", action="store_true", help="Report the adjusted Rand index of an approximate kmeans mode against the exact mode")
+    parser.add_argument("--corr", help="Calculate the correlation between weak behaviors of the specified dataset, or of the result with this rowid in an export")
+    parser.add_argument("--engine", default="json", choices=["json", "numpy", "sql"], help="Compute per test stats from the JSON results in Python (json) or with NumPy (numpy), or from the normalized test_results table (sql)")
+    parser.add_argument("--cache", action="store_true", help="Reuse per test stats stored in the database by earlier runs")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of processes used by --avg and --bugs")
+    parser.add_argument("--quantiles", default="exact", choices=["exact", "sketch"], help="Keep every rate and time for exact medians and quantiles, or a bounded size sketch of them (see sketch.py)")
+    parser.add_argument("--incremental", action="store_true", help="Store the results of --avg and --bugs, and only process rows added since the last incremental run")
+    parser.add_argument("--rollup", action="store_true", help="Answer --avg all, vendor, arch or device from a rollup of every grouping stored in the database, adding the rows inserted since the last run")
+    parser.add_argument("--split", choices=["os", "browser"], help="With --rollup, split every group by os or browser")
+    parser.add_argument("--profile", action="store_true", help="Print the time, rows and bytes decoded per phase, and the peak memory, as JSON to stderr")
+    parser.add_argument("--profile-output", help="Write the --profile summary to this file instead")
     args = parser.parse_args()
-    cursor = db_conn(args.db_path)
-    if args.rowid:
-        print_json(analyze_rowid(cursor, int(args.rowid), args.legacy))
+    if args.profile or args.profile_output:
+        profiler.enable()
+    filters = {name: getattr(args, name) for name in filter_columns}
+    if args.include_invalid:
+        filters["include_invalid"] = True
+    if args.avg == "source" and len(args.db_path) == 1:
+        parser.error("--avg source needs several databases")
+    db_path = args.db_path[0]
+    # Several databases are analyzed together, and a directory is an export written by export.py
+    cursor = None if len(args.db_path) > 1 or os.path.isdir(db_path) else db_conn(db_path)
+    if len(args.db_path) > 1:
+        federated_main(open_sources(args.db_path), args, filters)
+    elif cursor is None:
+        export_main(db_path, args, filters)
+    elif args.checksum:
+        print_json(invalid_rows(cursor, args.vendor, args.legacy, args.mobile, filters))
+    elif args.best_params:
+        cube = update_best_params(cursor, args.legacy, args.top)
+        if args.vendor:
+            print_json(best_params(cursor, cube, args.vendor, args.architecture, args.description, args.test))
+        else:
+            print_json(best_params_index(cursor, cube))
+    elif args.rowid:
+        print_json(analyze_rowid(cursor, int(args.rowid), args.legacy, args.engine, args.cache))
+    elif args.bugs and args.incremental:
+        print_json(incremental_bugs(cursor, args.vendor, args.legacy, args.mobile, args.engine, args.cache, filters))
     elif args.bugs:
-        print_json(find_bugs(cursor, args.vendor, args.legacy, args.mobile))
+        print_json(find_bugs(cursor, args.vendor, args.legacy, args.mobile, args.engine, args.cache, args.jobs, filters))
+    elif args.avg and args.rollup:
+        print_json(rollup_analyze(cursor, args.avg, args.vendor, args.legacy, args.mobile, args.engine, args.cache, filters, args.split))
+    elif args.avg and args.incremental:
+        print_json(incremental_analyze(cursor, args.avg, args.vendor, args.legacy, args.mobile, args.engine, args.cache, filters, args.quantiles))
     elif args.avg:
-        print_json(analyze(cursor, args.avg, args.vendor, args.legacy, args.mobile))
+        print_json(analyze(cursor, args.avg, args.vendor, args.legacy, args.mobile, args.engine, args.cache, args.jobs, filters, args.quantiles))
+    elif (args.nearest is not None or args.similarity) and args.legacy:
+        raise SystemExit("Legacy results have no tuning tests to compare devices by")
+    elif args.nearest is not None:
+        matrix, meta = normalized_features(cursor, args.vendor, args.mobile, args.engine, filters, args.features)
+        print_json(nearest(matrix, meta, args.nearest, args.k or 10))
+    elif args.similarity and args.k:
+        matrix, meta = normalized_features(cursor, args.vendor, args.mobile, args.engine, filters, args.features)
+        res = blocked_similarity(matrix, meta, args.k)
+        nearest_csv(res, "nearest.csv")
+        del res["neighbours"]
+        print_json(res)
     elif args.similarity:
-        res = similarity(cursor, args.vendor, args.mobile)
+        res = similarity(cursor, args.vendor, args.mobile, args.engine, filters)
         res["similarity"].to_csv("similarity.csv")
     elif args.kmeans:
-        sim_res = similarity(cursor, args.vendor, args.mobile)
-        print_json(kmeans(sim_res, int(args.kmeans)))
+        sim_res = similarity(cursor, args.vendor, args.mobile, args.engine, filters)
+        print_json(kmeans(sim_res, int(args.kmeans), args.kmeans_mode, args.kmeans_agreement))
     elif args.corr:
         print(correlate(load_stats(args.corr)))
+    if profiler.enabled:
+        profiler.report(args.profile_output)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,173 @@
+import argparse
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import time
+from statistics import median
+
+# Modules that quick queries must not load
+heavy_modules = ["numpy", "pandas", "sklearn", "scipy", "joblib", "matplotlib"]
+
+def imported_modules(command):
+    proc = subprocess.run([sys.executable, "-X", "importtime"] + command, capture_output=True, text=True, check=True)
+    modules = set()
+    for line in proc.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            modules.add(line.split("|")[-1].strip().split(".")[0])
+    return modules
+
+def time_command(command, runs):
+    times = []
+    for i in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + command, capture_output=True, check=True)
+        times.append(time.perf_counter() - start)
+    return median(times)
+
+def startup(db_path, runs):
+    import insert
+    con = sqlite3.connect(db_path)
+    rowid = con.execute("select min(rowid) from tuning_results").fetchone()[0]
+    legacy = ["--legacy"] if insert.is_legacy_table(con.cursor()) else []
+    commands = {
+        "python": ["-c", "pass"],
+        "analyze --rowid": ["analyze.py", db_path, "--rowid", str(rowid)] + legacy,
+        "analyze --bugs": ["analyze.py", db_path, "--bugs"] + legacy,
+        "figures --help": ["figures.py", "--help"]
+    }
+    report = {}
+    for name in commands:
+        report[name] = {
+            "seconds": time_command(commands[name], runs),
+            "heavyModules": sorted(set(heavy_modules) & imported_modules(commands[name]))
+        }
+    return report
+
+def scaling_db(work_dir, rows, is_legacy, iterations, seed):
+    from synth import generate_db
+    layout = "legacy" if is_legacy else "webgpu"
+    db_path = os.path.join(work_dir, "{}-{}-{}-{}.db".format(layout, rows, iterations, seed))
+    # Generated databases are reused across runs, so reports of different commits time the same data
+    if not os.path.exists(db_path):
+        generate_db(db_path + ".tmp", rows, is_legacy, iterations, seed)
+        os.replace(db_path + ".tmp", db_path)
+    return db_path
+
+# Runs in a fresh process, so the peak memory is that of a single benchmark
+def measure(job):
+    mode, rows, db_path, is_legacy, iterations, seed, engine, jobs = job
+    import analyze
+    import insert
+    import synth
+    if mode in ["similarity", "correlate"]:
+        # Import time is measured by --startup, not here
+        import pandas
+        import sklearn.metrics.pairwise
+    if mode == "insert":
+        json_dir = db_path + "-json"
+        paths = synth.generate_files(json_dir, rows, is_legacy, iterations, seed)
+        out_path = json_dir + ".db"
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        con = insert.db_conn(out_path)
+        start = time.perf_counter()
+        insert.bulk_insert(con, paths, is_legacy, jobs, False)
+        elapsed = time.perf_counter() - start
+        con.close()
+        os.remove(out_path)
+        return elapsed, analyze.peak_rss_mb()
+    if mode == "correlate":
+        # Correlation is over the iterations of one submission, so its size is the number of iterations
+        dataset = synth.submission(random.Random(seed), is_legacy, rows)
+        if not is_legacy:
+            # Leave out the conformance iterations, they only run one test
+            dataset = {str(i): dataset[str(i)] for i in range(rows)}
+        start = time.perf_counter()
+        analyze.correlate(dataset)
+        return time.perf_counter() - start, analyze.peak_rss_mb()
+    cursor = analyze.db_conn(db_path)
+    start = time.perf_counter()
+    if mode == "analyze":
+        analyze.analyze(cursor, "all", None, is_legacy, False, engine, jobs=jobs)
+    elif mode == "find_bugs":
+        analyze.find_bugs(cursor, None, is_legacy, False, engine, jobs=jobs)
+    elif mode == "similarity":
+        analyze.similarity(cursor, None, False, engine)
+    return time.perf_counter() - start, analyze.peak_rss_mb()
+
+def git_commit():
+    proc = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True)
+    if proc.returncode:
+        return None
+    return proc.stdout.strip()
+
+def scaling(sizes, is_legacy, iterations, seed, engine, jobs, work_dir):
+    os.makedirs(work_dir, exist_ok=True)
+    modes = ["insert", "analyze", "find_bugs", "similarity", "correlate"]
+    if is_legacy:
+        # The legacy results have no tuning tests to compare devices by
+        modes.remove("similarity")
+    results = []
+    for rows in sizes:
+        db_path = scaling_db(work_dir, rows, is_legacy, iterations, seed)
+        for mode in modes:
+            job = [mode, rows, db_path, is_legacy, iterations, seed, engine, jobs]
+            command = "import bench, json, sys; print(json.dumps(bench.measure(json.loads(sys.argv[1]))))"
+            proc = subprocess.run([sys.executable, "-c", command, json.dumps(job)],
+                                  capture_output=True, text=True, check=True)
+            seconds, peak = json.loads(proc.stdout.splitlines()[-1])
+            print("{} {} rows: {:.3f}s".format(mode, rows, seconds), file=sys.stderr)
+            results.append({
+                "benchmark": mode,
+                "rows": rows,
+                "seconds": seconds,
+                "rowsPerSecond": rows / seconds if seconds else None,
+                "peakMemoryMB": peak
+            })
+    return {
+        "commit": git_commit(),
+        "layout": "legacy" if is_legacy else "webgpu",
+        "iterations": iterations,
+        "engine": engine,
+        "jobs": jobs,
+        "seed": seed,
+        "results": results
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--startup", action="store_true", help="Time the startup of quick queries and check they don't import heavy modules")
+    parser.add_argument("--db", default="dbs/vulkan.db", help="Database used by the benchmarks")
+    parser.add_argument("--runs", type=int, default=5, help="Number of runs per benchmark, the median is reported")
+    parser.add_argument("--scaling", action="store_true", help="Time insert, analyze, find_bugs, similarity and correlate on synthetic databases of growing size")
+    parser.add_argument("--sizes", default="10,100,1000,10000", help="Comma separated numbers of rows for --scaling")
+    parser.add_argument("--legacy", action="store_true", help="Use legacy Android app results for --scaling")
+    parser.add_argument("--iterations", type=int, help="Number of tuning iterations per synthetic submission (default 50, or 150 for legacy)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the synthetic data")
+    parser.add_argument("--engine", choices=["json", "numpy", "sql"], default="json", help="Statistics engine used by --scaling")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of processes used by --scaling")
+    parser.add_argument("--work-dir", default="bench-data", help="Directory of the synthetic databases")
+    parser.add_argument("--output", help="Write the --scaling report to this JSON file")
+    args = parser.parse_args()
+    if args.startup:
+        report = startup(args.db, args.runs)
+        print(json.dumps(report, indent=2))
+        failed = [name for name in report if report[name]["heavyModules"]]
+        if failed:
+            print("Heavy modules imported by: {}".format(", ".join(failed)))
+            sys.exit(1)
+    if args.scaling:
+        sizes = [int(size) for size in args.sizes.split(",")]
+        iterations = args.iterations or (150 if args.legacy else 50)
+        report = scaling(sizes, args.legacy, iterations, args.seed, args.engine, args.jobs, args.work_dir)
+        if args.output:
+            with open(args.output, "w") as out_file:
+                json.dump(report, out_file, indent=2)
+        else:
+            print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
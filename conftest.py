@@ -0,0 +1,11 @@
+import pytest
+from insert import db_conn, migrate
+from synth import generate_db
+
+# A small migrated database of synthetic WebGPU results
+@pytest.fixture
+def synth_db(tmp_path):
+    db_path = str(tmp_path / "synth.db")
+    generate_db(db_path, 30, False, 10)
+    migrate(db_conn(db_path))
+    return db_path
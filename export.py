@@ -0,0 +1,166 @@
+import argparse
+import json
+import os
+import shutil
+from analyze import db_conn, flatten_dataset, device_filter_values, export_arrays
+from insert import decode_results, table_columns, validate
+
+# Appends arrays to a raw file, which is turned into a .npy file once its final shape is known
+class ArrayWriter:
+    def __init__(self, path, dtype, width=None):
+        import numpy as np
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.width = width
+        self.length = 0
+        self.raw = open(path + ".raw", "wb")
+
+    def append(self, values):
+        import numpy as np
+        values = np.ascontiguousarray(values, dtype=self.dtype)
+        self.raw.write(values.tobytes())
+        self.length += len(values)
+
+    def close(self):
+        import numpy as np
+        self.raw.close()
+        shape = (self.length,) if self.width is None else (self.length, self.width)
+        with open(self.path, "wb") as out_file:
+            np.lib.format.write_array_header_1_0(out_file, {
+                "descr": np.lib.format.dtype_to_descr(self.dtype),
+                "fortran_order": False,
+                "shape": shape
+            })
+            with open(self.path + ".raw", "rb") as raw:
+                shutil.copyfileobj(raw, out_file)
+        os.remove(self.path + ".raw")
+
+# Writes the counts, durations and params of every result to .npy files in out_dir, one entry per test of
+# every iteration, in the same order as the results. Device metadata goes to devices.json.
+def export(cursor, out_dir, is_legacy):
+    import numpy as np
+    os.makedirs(out_dir, exist_ok=True)
+    writers = {}
+    for name in export_arrays:
+        dtype, width = export_arrays[name]
+        writers[name] = ArrayWriter(os.path.join(out_dir, name + ".npy"), dtype, width)
+    tests = {}
+    params = {}
+    devices = []
+    num_entries = 0
+    num_iterations = 0
+    num_params = 0
+    for name in ["entry_offsets", "iteration_offsets", "param_offsets"]:
+        writers[name].append([0])
+    valid_column = "valid" if "valid" in table_columns(cursor) else "null"
+    query = "select rowid, results, {} from tuning_results order by rowid".format(valid_column)
+    for rowid, results, valid in cursor.execute(query):
+        data = decode_results(results)
+        flat = flatten_dataset(data)
+        codes = np.array([tests.setdefault(test, len(tests)) for test in flat["tests"]], dtype=np.int32)
+        writers["result_ids"].append([rowid])
+        writers["test_codes"].append(codes[flat["test_codes"]] if len(codes) else [])
+        writers["iterations"].append(flat["iterations"])
+        writers["tuning"].append(flat["tuning"])
+        writers["counts"].append(flat["counts"])
+        writers["durations"].append(flat["durations"])
+        for key in flat["keys"]:
+            if str(int(key)) != key:
+                raise ValueError("Row {} has iteration key {}, which can't be stored as a number".format(rowid, key))
+        writers["iteration_keys"].append([int(key) for key in flat["keys"]])
+        param_iterations = []
+        param_codes = []
+        param_values = []
+        for i in range(len(flat["keys"])):
+            iteration_params = data[flat["keys"][i]].get("params", {})
+            for name in iteration_params:
+                param_iterations.append(num_iterations + i)
+                param_codes.append(params.setdefault(name, len(params)))
+                param_values.append(iteration_params[name])
+        writers["param_iterations"].append(param_iterations)
+        writers["param_codes"].append(param_codes)
+        writers["param_values"].append(param_values)
+        num_entries += len(flat["test_codes"])
+        num_iterations += len(flat["keys"])
+        num_params += len(param_codes)
+        writers["entry_offsets"].append([num_entries])
+        writers["iteration_offsets"].append([num_iterations])
+        writers["param_offsets"].append([num_params])
+        device = device_filter_values(data["platformInfo"])
+        device["rowid"] = rowid
+        # Rows inserted before validation existed are validated here
+        device["valid"] = bool(valid) if valid is not None else validate(data, is_legacy) is None
+        device["platformInfo"] = data["platformInfo"]
+        devices.append(device)
+    for writer in writers.values():
+        writer.close()
+    with open(os.path.join(out_dir, "devices.json"), "w") as out_file:
+        json.dump(devices, out_file)
+    with open(os.path.join(out_dir, "meta.json"), "w") as out_file:
+        json.dump({"legacy": is_legacy, "tests": list(tests), "params": list(params)}, out_file, indent=2)
+    return len(devices)
+
+# Writes the entries, params and devices of an export to Parquet files next to it, in batches of results
+def export_parquet(out_dir, batch_size=1000):
+    import numpy as np
+    import pyarrow
+    import pyarrow.parquet
+    from analyze import load_export
+    exported = load_export(out_dir)
+    arrays = exported["arrays"]
+    tests = np.array(exported["meta"]["tests"], dtype=object)
+    param_names = np.array(exported["meta"]["params"], dtype=object)
+    entry_offsets = arrays["entry_offsets"]
+    iteration_offsets = arrays["iteration_offsets"]
+    param_offsets = arrays["param_offsets"]
+    entries_writer = None
+    params_writer = None
+    num_results = len(arrays["result_ids"])
+    for start in range(0, num_results, batch_size):
+        end = min(start + batch_size, num_results)
+        entries = slice(entry_offsets[start], entry_offsets[end])
+        params = slice(param_offsets[start], param_offsets[end])
+        result_ids = np.repeat(arrays["result_ids"][start:end], np.diff(entry_offsets[start:end + 1]))
+        iteration_results = np.repeat(arrays["result_ids"][start:end], np.diff(iteration_offsets[start:end + 1]))
+        entry_iterations = arrays["iterations"][entries] + np.repeat(iteration_offsets[start:end], np.diff(entry_offsets[start:end + 1]))
+        entries_table = pyarrow.table({
+            "result_id": result_ids,
+            "iteration": arrays["iteration_keys"][entry_iterations],
+            "test": tests[arrays["test_codes"][entries]],
+            "tuning": arrays["tuning"][entries],
+            "seq": arrays["counts"][entries, 0],
+            "interleaved": arrays["counts"][entries, 1],
+            "weak": arrays["counts"][entries, 2],
+            "duration_seconds": arrays["durations"][entries]
+        })
+        param_iterations = arrays["param_iterations"][params]
+        params_table = pyarrow.table({
+            "result_id": iteration_results[param_iterations - iteration_offsets[start]],
+            "iteration": arrays["iteration_keys"][param_iterations],
+            "name": param_names[arrays["param_codes"][params]],
+            "value": arrays["param_values"][params]
+        })
+        if entries_writer is None:
+            entries_writer = pyarrow.parquet.ParquetWriter(os.path.join(out_dir, "entries.parquet"), entries_table.schema)
+            params_writer = pyarrow.parquet.ParquetWriter(os.path.join(out_dir, "params.parquet"), params_table.schema)
+        entries_writer.write_table(entries_table)
+        params_writer.write_table(params_table)
+    if entries_writer is not None:
+        entries_writer.close()
+        params_writer.close()
+    devices = [dict(device, platformInfo=json.dumps(device["platformInfo"])) for device in exported["devices"]]
+    pyarrow.parquet.write_table(pyarrow.Table.from_pylist(devices), os.path.join(out_dir, "devices.parquet"))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("db_path", help="Path to sqlite database")
+    parser.add_argument("out_dir", help="Directory to write the export to")
+    parser.add_argument("--legacy", action="store_true", help="Export legacy Android app results")
+    parser.add_argument("--parquet", action="store_true", help="Also write the export as Parquet files (needs pyarrow)")
+    args = parser.parse_args()
+    print("Exported {} results".format(export(db_conn(args.db_path), args.out_dir, args.legacy)))
+    if args.parquet:
+        export_parquet(args.out_dir)
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,10 @@
-import matplotlib.pyplot as plt
-import matplotlib
-import numpy as np
 from analyze import *
 import argparse
 import os
 
-if not os.path.exists("figures"):
-    os.makedirs("figures")
-
 VULKAN_DB_PATH = "dbs/vulkan.db"
 WEBGPU_DB_PATH = "dbs/gpuharbor.db"
 
-matplotlib.rcParams['text.usetex'] = True
-
 vulkan_devices = ["Adreno 610", "Adreno 640", "Adreno 642L", "Adreno 660", "Mali - G71", "Mali - G78", "GE8320", "Tegra X1"]
 
 vulkan_vendors = ["PowerVR", "Arm", "Qualcomm", "NVIDIA"]
@@ -23,6 +15,15 @@ webgpu_vendors = ["Intel", "Apple", "NVIDIA", "AMD"]
 
 webgpu_db_vendor_order = ["intel", "apple", "nvidia", "amd"]
 
+# matplotlib is only loaded (and the figures directory created) by the options that draw figures
+def pyplot():
+    import matplotlib
+    matplotlib.rcParams['text.usetex'] = True
+    import matplotlib.pyplot as plt
+    if not os.path.exists("figures"):
+        os.makedirs("figures")
+    return plt
+
 def pct(value, total=1):
     return value/total * 100
 
@@ -37,9 +38,8 @@ def build_table(labels, mp_data, lb_data, sb_data, s_data, r_data, w_data):
     for i in range(len(labels)):
         print("{} & {} & {} & {} & {} & {} & {} \\\\".format(labels[i], round_number(mp_data[i]), round_number(lb_data[i]), round_number(sb_data[i]), round_number(s_data[i]), round_number(r_data[i]), round_number(w_data[i])))
 
-def vulkan_rates():
-    cursor = db_conn(VULKAN_DB_PATH)
-    data = analyze(cursor, "indiv", None, True, False)
+def vulkan_rates(session):
+    data = session.analyze("indiv")
     mp_rates = []
     lb_rates = []
     sb_rates = []
@@ -57,10 +57,9 @@ def vulkan_rates():
 
     build_table(vulkan_devices, mp_rates, lb_rates, sb_rates, s_rates, r_rates, w_rates)
 
-def webgpu_rates():
-    cursor = db_conn(WEBGPU_DB_PATH)
-    data = analyze(cursor, "vendor", None, False, False)
-    all_data = analyze(cursor, "all", None, False, False)
+def webgpu_rates(session):
+    data = session.analyze("vendor")
+    all_data = session.analyze("all")
     mp_rates = []
     lb_rates = []
     sb_rates = []
@@ -86,6 +85,8 @@ def webgpu_rates():
 
     labels = webgpu_vendors + ["All"]
 
+    import numpy as np
+    plt = pyplot()
     x = np.arange(len(labels))
     y = np.arange(0, 11, 2)
     width = 0.1
@@ -115,68 +116,67 @@ def webgpu_rates():
     print("Writing WebGPU weak behavior rates")
     make_fig(mp_rates, lb_rates, sb_rates, s_rates, r_rates, w_rates, "Average", "rates")
 
-def webgpu_similarity():
+def webgpu_similarity(session):
     def _round(val):
         return round(val, 3)
-    cursor = db_conn(WEBGPU_DB_PATH)
     print("Vendor & Avg & Median & Min & Max \\\\")
     for i in range(len(webgpu_db_vendor_order)):
         vendor = webgpu_db_vendor_order[i]
-        sim = similarity(cursor, vendor, False)
+        sim = session.similarity(vendor)
         print("{} & {} & {} & {} & {} \\\\".format(webgpu_vendors[i], _round(sim["avg"]), _round(sim["median"]), _round(sim["min"]), _round(sim["max"])))
-    sim = similarity(cursor, None, False)
+    sim = session.similarity()
     print("All & {} & {} & {} & {} \\\\".format(_round(sim["avg"]), _round(sim["median"]), _round(sim["min"]), _round(sim["max"])))
 
-def webgpu_kmeans():
+def webgpu_kmeans(session, mode="exact"):
     def vendor_value(counts, vendor):
         if vendor in counts:
             return counts[vendor]
         return 0
-    cursor = db_conn(WEBGPU_DB_PATH)
-    sim_res = similarity(cursor, None, False)
+    sim_res = session.similarity()
+    sweep = kmeans_sweep(sim_res, range(1, 11), mode, agreement=mode != "exact")
     distortions = []
     for i in range(1, 11):
-        kmeans_res = kmeans(sim_res, i)
-        distortions.append(kmeans_res["inertia"])
-    good_kmeans = kmeans(sim_res, 6)
+        distortions.append(sweep[i]["inertia"])
+    good_kmeans = sweep[6]
+    if mode != "exact":
+        print("% Agreement with exact kmeans (adjusted Rand index): {}".format(round(good_kmeans["agreement"], 3)))
     for i in range(len(webgpu_db_vendor_order)):
         vendor = webgpu_db_vendor_order[i]
         print("{} & {} & {} & {} & {} & {} & {} \\\\".format(webgpu_vendors[i], vendor_value(good_kmeans["0"]["counts"], vendor), vendor_value(good_kmeans["1"]["counts"], vendor), vendor_value(good_kmeans["2"]["counts"], vendor), vendor_value(good_kmeans["3"]["counts"], vendor), vendor_value(good_kmeans["4"]["counts"], vendor), vendor_value(good_kmeans["5"]["counts"], vendor)))
 
-def vulkan_summary():
+def vulkan_summary(session):
     def round_millions(value):
         return round(value/1000000, 1)
     def round_thousands(value):
         return round(value/1000, 1)
 
-    cursor = db_conn(VULKAN_DB_PATH)
-    data = analyze(cursor, "vendor", None, True, False)
-    all_data = analyze(cursor, "all", None, True, False)
+    data = session.analyze("vendor")
+    all_data = session.analyze("all")
     for i in range(len(vulkan_db_vendor_order)):
         vendor = vulkan_db_vendor_order[i]
         print("& {} & {} ({}) & {}m & {}k \\\\".format(vulkan_vendors[i], data[vendor]["total"], data[vendor]["uniqueDevices"], round_millions(data[vendor]["weakTestInstances"]), round_thousands(data[vendor]["weakBehaviors"])))
     print("All & {} ({}) & {}m & {}k".format(all_data["all"]["total"], all_data["all"]["uniqueDevices"], round_millions(all_data["all"]["weakTestInstances"]), round_thousands(all_data["all"]["weakBehaviors"])))
 
-def webgpu_summary():
+def webgpu_summary(session):
     def round_billions(value):
         return round(value/1000000000, 1)
     def round_millions(value):
         return round(value/1000000, 1)
 
-    cursor = db_conn(WEBGPU_DB_PATH)
-    data = analyze(cursor, "vendor", None, False, False)
-    all_data = analyze(cursor, "all", None, False, False)
+    data = session.analyze("vendor")
+    all_data = session.analyze("all")
     for i in range(len(webgpu_db_vendor_order)):
         vendor = webgpu_db_vendor_order[i]
         print("& {} & {} ({}) & {}b & {}m \\\\".format(webgpu_vendors[i], data[vendor]["total"], data[vendor]["uniqueDevices"], round_billions(data[vendor]["weakTestInstances"]), round_millions(data[vendor]["weakBehaviors"])))
     print("All & {} ({}) & {}b & {}m".format(all_data["all"]["total"], all_data["all"]["uniqueDevices"], round_billions(all_data["all"]["weakTestInstances"]), round_millions(all_data["all"]["weakBehaviors"])))
 
-def webgpu_timing():
-    cursor = db_conn(WEBGPU_DB_PATH)
-    data = analyze(cursor, "vendor", None, False, False)
+def webgpu_timing(session):
+    data = session.analyze("vendor")
     times = []
     for vendor in webgpu_db_vendor_order:
         times.append(data[vendor]["times"])
+    import numpy as np
+    plt = pyplot()
     fig, ax = plt.subplots(1, 1, figsize=(6, 3))
     ax.hist(times, bins="fd", label=webgpu_vendors, stacked=True)
     x = np.arange(0, 8100, 900)
@@ -208,24 +208,49 @@ def main():
     parser.add_argument("--vulkan-summary", action="store_true", help="Calculate summary of Vulkan devices/tests")
     parser.add_argument("--vulkan-rates", action="store_true", help="Calculate Vulkan weak rate behavior")
     parser.add_argument("--bug-corr", action="store_true", help="Calculate correlation between mutants and bugs")
+    parser.add_argument("--all", action="store_true", help="Generate every table and figure, loading each database once")
+    parser.add_argument("--kmeans-mode", default="exact", choices=["exact", "minibatch", "pca"], help="Clustering mode for --webgpu-kmeans, see analyze.py")
+    parser.add_argument("--profile", action="store_true", help="Print the time, rows and bytes decoded per phase, and the peak memory, as JSON to stderr")
+    parser.add_argument("--profile-output", help="Write the --profile summary to this file instead")
 
     args = parser.parse_args()
-    if args.webgpu_summary:
-        webgpu_summary()
+    if args.profile or args.profile_output:
+        profiler.enable()
+    if args.all:
+        webgpu = Session(db_conn(WEBGPU_DB_PATH), False)
+        vulkan = Session(db_conn(VULKAN_DB_PATH), True)
+        print("% Table 1: WebGPU summary")
+        webgpu_summary(webgpu)
+        print("% Table 1: Vulkan summary")
+        vulkan_summary(vulkan)
+        webgpu_timing(webgpu)
+        webgpu_rates(webgpu)
+        print("% Table 2: Vulkan rates")
+        vulkan_rates(vulkan)
+        print("% Table 3: WebGPU similarity")
+        webgpu_similarity(webgpu)
+        print("% Table 4: WebGPU kmeans")
+        webgpu_kmeans(webgpu, args.kmeans_mode)
+        print("% Section 5.1: Bug correlation")
+        bug_corr()
+    elif args.webgpu_summary:
+        webgpu_summary(Session(db_conn(WEBGPU_DB_PATH), False))
     elif args.webgpu_timing:
-        webgpu_timing()
+        webgpu_timing(Session(db_conn(WEBGPU_DB_PATH), False))
     elif args.webgpu_rates:
-        webgpu_rates()
+        webgpu_rates(Session(db_conn(WEBGPU_DB_PATH), False))
     elif args.webgpu_similarity:
-        webgpu_similarity()
+        webgpu_similarity(Session(db_conn(WEBGPU_DB_PATH), False))
     elif args.webgpu_kmeans:
-        webgpu_kmeans()
+        webgpu_kmeans(Session(db_conn(WEBGPU_DB_PATH), False), args.kmeans_mode)
     elif args.vulkan_summary:
-        vulkan_summary()
+        vulkan_summary(Session(db_conn(VULKAN_DB_PATH), True))
     elif args.vulkan_rates:
-        vulkan_rates()
+        vulkan_rates(Session(db_conn(VULKAN_DB_PATH), True))
     elif args.bug_corr:
         bug_corr()
+    if profiler.enabled:
+        profiler.report(args.profile_output)
 
 if __name__ == "__main__":
     main()
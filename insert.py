@@ -1,7 +1,26 @@
 import argparse
+import glob
+import hashlib
 import json
+import os
 import sqlite3
 import re
+import time
+import zlib
+
+# Pattern for checking that key matches a number
+iter_p = re.compile(r'\d+')
+
+# orjson parses stored results faster when it is installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# Stress params are flat objects, so they can be cut out of the text before it is parsed
+params_p = re.compile(r'"params":\s*\{[^{}]*\}')
+params_bytes_p = re.compile(rb'"params":\s*\{[^{}]*\}')
 
 def load_stats(stats_path):
     with open(stats_path, "r") as stats_file:
@@ -9,7 +28,110 @@ def load_stats(stats_path):
         return dataset
 
 def db_conn(db_path):
-    return sqlite3.connect(db_path)
+    con = sqlite3.connect(db_path)
+    con.create_function("results_json", 1, results_json, deterministic=True)
+    return con
+
+# Results are stored as JSON text, or as a BLOB starting with a format marker. zlib and zstd compress the
+# JSON text, msgpack is the msgpack encoding compressed with zlib. zstd and msgpack need the zstandard
+# and msgpack packages.
+result_formats = {
+    "zlib": b"Z1",
+    "zstd": b"S1",
+    "msgpack": b"M1"
+}
+
+def encode_results(data, results_format="json", text=None):
+    if text is None:
+        text = json.dumps(data)
+    if results_format == "json":
+        return text
+    if results_format == "zlib":
+        payload = zlib.compress(text.encode(), 9)
+    elif results_format == "zstd":
+        import zstandard
+        payload = zstandard.ZstdCompressor().compress(text.encode())
+    elif results_format == "msgpack":
+        import msgpack
+        payload = zlib.compress(msgpack.packb(data), 9)
+    else:
+        raise ValueError("Unknown results format {}".format(results_format))
+    return result_formats[results_format] + payload
+
+# With skip_params every iteration's params are decoded as an empty object, for analyses that don't use them
+def decode_results(results, skip_params=False):
+    marker = None if isinstance(results, str) else bytes(results[:2])
+    if marker is None:
+        text = results
+    elif marker == result_formats["zlib"]:
+        text = zlib.decompress(results[2:])
+    elif marker == result_formats["zstd"]:
+        import zstandard
+        text = zstandard.ZstdDecompressor().decompress(results[2:])
+    elif marker == result_formats["msgpack"]:
+        import msgpack
+        return msgpack.unpackb(zlib.decompress(results[2:]))
+    else:
+        raise ValueError("Unknown results format marker {!r}".format(marker))
+    if skip_params and isinstance(text, str):
+        text = params_p.sub('"params": {}', text)
+    elif skip_params:
+        text = params_bytes_p.sub(b'"params": {}', text)
+    return json_loads(text)
+
+# The results as JSON text, for json_extract
+def results_json(results):
+    if isinstance(results, str):
+        return results
+    return json.dumps(decode_results(results))
+
+# Only stored BLOBs go through Python
+results_json_sql = "(case when typeof(results) = 'text' then results else results_json(results) end)"
+
+def results_format_of(results):
+    if isinstance(results, str):
+        return "json"
+    for results_format in result_formats:
+        if bytes(results[:2]) == result_formats[results_format]:
+            return results_format
+    return None
+
+# Re-encodes the stored results in place. The content hash is of the JSON text, so it stays the same. Triggers
+# drop the normalized rows of changed results, so they are shredded again.
+def convert(con, results_format, batch_size=500):
+    cursor = con.cursor()
+    create_table(cursor)
+    backfill_hashes(cursor)
+    has_shredded = cursor.execute("select 1 from sqlite_master where type = 'table' and name = 'shredded_results'").fetchone()
+    converted = 0
+    last_rowid = None
+    while True:
+        if last_rowid is None:
+            rows = cursor.execute("select rowid, results, content_hash from tuning_results order by rowid limit ?", [batch_size]).fetchall()
+        else:
+            rows = cursor.execute("select rowid, results, content_hash from tuning_results where rowid > ? order by rowid limit ?",
+                                  [last_rowid, batch_size]).fetchall()
+        if not rows:
+            break
+        last_rowid = rows[-1][0]
+        updates = []
+        changed = []
+        for rowid, results, results_hash in rows:
+            if results_format_of(results) != results_format:
+                data = decode_results(results)
+                updates.append((encode_results(data, results_format), rowid))
+                changed.append((rowid, data, results_hash))
+        cursor.executemany("update tuning_results set results = ? where rowid = ?", updates)
+        # Triggers on results clear the hash of updated rows
+        cursor.executemany("update tuning_results set content_hash = ? where rowid = ?",
+                           [(row[2], row[0]) for row in rows])
+        if has_shredded:
+            for rowid, data, results_hash in changed:
+                shred_res(cursor, rowid, data, results_hash)
+        converted += len(updates)
+    con.commit()
+    cursor.execute("vacuum")
+    return converted
 
 def create_table(cursor):
     cursor.execute("""
@@ -21,13 +143,362 @@ def create_table(cursor):
         os text,
         framework text,
         random_seed text,
-        results text
+        results text,
+        content_hash text
       )
 """)
+    add_missing_columns(cursor, [("content_hash", "text")] + device_columns + validity_columns)
+    create_indexes(cursor)
 
-def insert_res(con, data):
+# The gpu architecture and description are copied out of platformInfo, so filtering on them never decodes the results
+device_columns = [("architecture", "text"), ("description", "text")]
+
+# Whether a result passed validate() when it was inserted, and the first failure if it didn't
+validity_columns = [("valid", "integer"), ("validation_error", "text")]
+
+# Columns analyses filter on. Legacy tables only have some of them.
+indexed_columns = ["gpu_vendor", "os", "browser", "framework", "architecture", "description", "content_hash", "valid"]
+
+def table_columns(cursor):
+    return [row[1] for row in cursor.execute("pragma table_info(tuning_results)")]
+
+# Legacy tables made by the Android app have no os column. Those created by insert.py --legacy or synth.py --legacy
+# have one, but never fill it in.
+def is_legacy_table(cursor):
+    if "os" not in table_columns(cursor):
+        return True
+    has_os = cursor.execute("select 1 from tuning_results where os is not null limit 1").fetchone()
+    has_rows = cursor.execute("select 1 from tuning_results limit 1").fetchone()
+    return has_rows is not None and has_os is None
+
+def create_indexes(cursor):
+    existing = table_columns(cursor)
+    for name in indexed_columns:
+        if name in existing:
+            cursor.execute("create index if not exists tuning_results_{0} on tuning_results ({0})".format(name))
+
+# Older databases were created before some columns existed
+def add_missing_columns(cursor, columns):
+    existing = table_columns(cursor)
+    for name, col_type in columns:
+        if name not in existing:
+            cursor.execute("alter table tuning_results add column {} {}".format(name, col_type))
+
+def content_hash(results):
+    return hashlib.sha256(results.encode()).hexdigest()
+
+def backfill_hashes(cursor):
+    rows = cursor.execute("select rowid, results from tuning_results where content_hash is null").fetchall()
+    cursor.executemany("update tuning_results set content_hash = ? where rowid = ?",
+                       [(content_hash(results_json(row[1])), row[0]) for row in rows])
+
+def backfill_device_columns(cursor):
+    cursor.execute("""
+        update tuning_results set
+            architecture = coalesce(json_extract({0}, '$.platformInfo.gpu.architecture'), ''),
+            description = coalesce(json_extract({0}, '$.platformInfo.gpu.description'), '')
+        where architecture is null
+""".format(results_json_sql))
+
+# Checks that every test of every iteration ran as many test instances as its params ask for. WebGPU tests run
+# iterations * testingWorkgroups * workgroupSize instances. Legacy tests each pick a workgroup size between
+# minWorkgroupSize and maxWorkgroupSize, so their totals are a multiple of testIterations * testingWorkgroups
+# within those bounds. Returns the first failure, or None if the result is valid.
+def validate(data, is_legacy):
+    import numpy as np
+    keys = []
+    tests = []
+    totals = []
+    bounds = []
+    for key in data:
+        if iter_p.match(key):
+            params = data[key].get("params", {})
+            try:
+                if is_legacy:
+                    step = params["testIterations"] * params["testingWorkgroups"]
+                    low, high = step * params["minWorkgroupSize"], step * params["maxWorkgroupSize"]
+                else:
+                    step = low = high = params["iterations"] * params["testingWorkgroups"] * params["workgroupSize"]
+            except KeyError as e:
+                return {"iteration": key, "error": "params have no {}".format(e.args[0])}
+            for test_key in data[key]:
+                if test_key != "params":
+                    test_data = data[key][test_key]
+                    keys.append(key)
+                    tests.append(test_key)
+                    totals.append(test_data["seq"] + test_data["interleaved"] + test_data["weak"])
+                    bounds.append((step, low, high))
+    if not totals:
+        return None
+    # All iterations are compared at once
+    totals = np.array(totals, dtype=np.int64)
+    step, low, high = np.array(bounds, dtype=np.int64).T
+    failed = np.flatnonzero((totals < low) | (totals > high) | (totals % np.maximum(step, 1) != 0))
+    if len(failed) == 0:
+        return None
+    first = failed[0]
+    return {
+        "iteration": keys[first],
+        "test": tests[first],
+        "expected": int(low[first]) if low[first] == high[first] else [int(low[first]), int(high[first])],
+        "actual": int(totals[first]),
+        "failures": len(failed)
+    }
+
+def validity_row(data, is_legacy):
+    error = validate(data, is_legacy)
+    return {
+        "valid": error is None,
+        "validation_error": None if error is None else json.dumps(error)
+    }
+
+def backfill_validity(cursor, is_legacy):
+    rows = cursor.execute("select rowid, results from tuning_results where valid is null").fetchall()
+    updates = []
+    for rowid, results in rows:
+        row = validity_row(decode_results(results), is_legacy)
+        updates.append((row["valid"], row["validation_error"], rowid))
+    cursor.executemany("update tuning_results set valid = ?, validation_error = ? where rowid = ?", updates)
+    # Analyses stored by analyze.py counted these rows as valid. The analysis_state_validity trigger catches this too,
+    # but older databases only have the trigger on results.
+    invalid = [rowid for valid, error, rowid in updates if not valid]
+    if invalid and cursor.execute("select 1 from sqlite_master where type = 'table' and name = 'analysis_state'").fetchone():
+        cursor.execute("delete from analysis_state where watermark >= ?", [min(invalid)])
+    return len(updates)
+
+# Per row stats cached by analyze.py --cache, keyed by the content hash of the results
+def create_stats_cache(cursor):
+    cursor.execute("""
+      create table if not exists stats_cache (
+        result_id integer,
+        legacy integer,
+        results_hash text,
+        version text,
+        stats text,
+        platform_info text,
+        primary key (result_id, legacy)
+      )
+""")
+    # Changing or deleting a row drops its cached stats. The hash is recomputed by the next insert.py run, and the row
+    # isn't cached until then.
+    cursor.execute("""
+      create trigger if not exists stats_cache_update after update of results on tuning_results
+      begin
+        delete from stats_cache where result_id = old.rowid;
+        update tuning_results set content_hash = null where rowid = new.rowid;
+      end
+""")
+    cursor.execute("""
+      create trigger if not exists stats_cache_delete after delete on tuning_results
+      begin
+        delete from stats_cache where result_id = old.rowid;
+      end
+""")
+    cursor.connection.commit()
+
+# Stored results of analyze.py --incremental, --rollup and --best-params, each up to a watermark rowid
+def create_analysis_state(cursor):
+    cursor.execute("""
+      create table if not exists analysis_state (
+        key text primary key,
+        watermark integer,
+        row_count integer,
+        state text
+      )
+""")
+    # Changing or deleting an already processed row forces a full rebuild
+    cursor.execute("""
+      create trigger if not exists analysis_state_update after update of results on tuning_results
+      begin
+        delete from analysis_state where watermark >= old.rowid;
+      end
+""")
+    # So does a row turning valid or invalid, e.g. when insert.py --migrate validates older rows
+    cursor.execute("""
+      create trigger if not exists analysis_state_validity after update of valid on tuning_results
+      when (old.valid is 0) is not (new.valid is 0)
+      begin
+        delete from analysis_state where watermark >= old.rowid;
+      end
+""")
+    cursor.execute("""
+      create trigger if not exists analysis_state_delete after delete on tuning_results
+      begin
+        delete from analysis_state where watermark >= old.rowid;
+      end
+""")
+    cursor.connection.commit()
+
+# The best stress parameters found for each test by analyze.py --best-params, per device, per architecture
+# (description null) and per vendor (architecture and description null), so new tuning runs can start from them.
+# cube is the analysis_state key of the rows and --top they were picked from.
+def create_best_params(cursor):
+    # Tables made before the cube column held a single index, which is rebuilt on the next run
+    columns = [row[1] for row in cursor.execute("pragma table_info(best_params)")]
+    if columns and "cube" not in columns:
+        cursor.execute("drop table best_params")
+        cursor.execute("delete from analysis_state where json_extract(key, '$[0][0]') = 'best_params'")
+    cursor.execute("""
+      create table if not exists best_params (
+        cube text,
+        vendor text,
+        architecture text,
+        description text,
+        test text,
+        rank integer,
+        rate real,
+        result_id integer,
+        iteration text,
+        params text
+      )
+""")
+    cursor.execute("create index if not exists best_params_key on best_params (cube, vendor, architecture, description, test)")
+    cursor.connection.commit()
+
+# Group stats of every level of the vendor, architecture and device hierarchy kept by analyze.py --rollup, each also
+# split by os and browser (split "os:<vendor>" or "browser:<vendor>", "" for the whole group). cube is the
+# analysis_state key of the rows a group covers.
+def create_rollup(cursor):
+    cursor.execute("""
+      create table if not exists rollup (
+        cube text,
+        level text,
+        vendor text,
+        group_key text,
+        split text,
+        first_rowid integer,
+        state text
+      )
+""")
+    cursor.execute("create unique index if not exists rollup_key on rollup (cube, level, group_key, split)")
+    cursor.connection.commit()
+
+def create_shred_tables(cursor):
+    # One row per (result, iteration, test), so analyses can aggregate integer columns
+    # instead of decoding the results blob. Position keeps the original test order.
+    cursor.execute("""
+      create table if not exists test_results (
+        result_id integer,
+        iteration integer,
+        position integer,
+        test text,
+        tuning integer,
+        seq integer,
+        interleaved integer,
+        weak integer,
+        duration_seconds real
+      )
+""")
+    cursor.execute("""
+      create table if not exists iteration_params (
+        result_id integer,
+        iteration integer,
+        name text,
+        value numeric
+      )
+""")
+    # The content hash of the results each result's rows were shredded from
+    cursor.execute("""
+      create table if not exists shredded_results (
+        result_id integer primary key,
+        content_hash text
+      )
+""")
+    # Covering indexes in the order the sql engine aggregates the rows in, replacing the plain result_id index
+    cursor.execute("drop index if exists test_results_result_id")
+    cursor.execute("""
+      create index if not exists test_results_stats
+      on test_results (result_id, tuning, test, position, seq, interleaved, weak, iteration)
+""")
+    cursor.execute("create index if not exists test_results_durations on test_results (result_id, position, duration_seconds)")
+    cursor.execute("create index if not exists iteration_params_result_id on iteration_params (result_id)")
+    # Changing or deleting a row drops its normalized rows. SQLite reuses the rowid of a deleted last row, so they
+    # would otherwise be mixed up with those of the next result.
+    for name, event in [("update", "update of results"), ("delete", "delete")]:
+        cursor.execute("""
+          create trigger if not exists shredded_{} after {} on tuning_results
+          begin
+            delete from test_results where result_id = old.rowid;
+            delete from iteration_params where result_id = old.rowid;
+            delete from shredded_results where result_id = old.rowid;
+          end
+""".format(name, event))
+
+# Returns the test_results and iteration_params rows of a result, without the result_id column
+def shred(data):
+    tests = []
+    params = []
+    position = 0
+    for key in data:
+        # Only match keys that are iteration numbers
+        if iter_p.match(key):
+            iteration = int(key)
+            # Conformance iterations only contain one test and the params
+            tuning = len(data[key].keys()) > 2
+            for test_key in data[key]:
+                if test_key == "params":
+                    for name in data[key]["params"]:
+                        params.append((iteration, name, data[key]["params"][name]))
+                else:
+                    test_data = data[key][test_key]
+                    tests.append((iteration, position, test_key, tuning, test_data["seq"],
+                                  test_data["interleaved"], test_data["weak"], test_data.get("durationSeconds")))
+                    position += 1
+    return tests, params
+
+# hashes are the (result_id, content_hash) of the results the rows come from
+def insert_shredded(cursor, tests, params, hashes):
+    cursor.executemany("""
+        INSERT INTO test_results
+            (result_id, iteration, position, test, tuning, seq, interleaved, weak, duration_seconds)
+        VALUES
+            (?, ?, ?, ?, ?, ?, ?, ?, ?)
+""", tests)
+    cursor.executemany("""
+        INSERT INTO iteration_params
+            (result_id, iteration, name, value)
+        VALUES
+            (?, ?, ?, ?)
+""", params)
+    cursor.executemany("insert or replace into shredded_results values (?, ?)", hashes)
+
+def shred_res(cursor, result_id, data, results_hash):
+    create_shred_tables(cursor)
+    tests, params = shred(data)
+    insert_shredded(cursor, [(result_id,) + test for test in tests], [(result_id,) + param for param in params],
+                    [(result_id, results_hash)])
+
+def migrate(con):
+    # Backfill the normalized tables, hashes, device columns and validity for rows inserted before they existed, and
+    # create the stats cache and the tables of stored analyses
     cursor = con.cursor()
+    is_legacy = is_legacy_table(cursor)
     create_table(cursor)
+    backfill_hashes(cursor)
+    backfill_device_columns(cursor)
+    backfill_validity(cursor, is_legacy)
+    create_stats_cache(cursor)
+    create_analysis_state(cursor)
+    create_best_params(cursor)
+    create_rollup(cursor)
+    create_shred_tables(cursor)
+    # Rows of results deleted before the triggers existed
+    cursor.execute("delete from test_results where result_id not in (select rowid from tuning_results)")
+    cursor.execute("delete from iteration_params where result_id not in (select rowid from tuning_results)")
+    # Rows not shredded yet, or changed since they were
+    rows = cursor.execute("""
+        select t.rowid, t.results, t.content_hash from tuning_results t
+        left join shredded_results s on s.result_id = t.rowid
+        where s.content_hash is not t.content_hash
+""").fetchall()
+    for rowid, results, results_hash in rows:
+        cursor.execute("delete from test_results where result_id = ?", [rowid])
+        cursor.execute("delete from iteration_params where result_id = ?", [rowid])
+        shred_res(cursor, rowid, decode_results(results), results_hash)
+    con.commit()
+    return len(rows)
+
+def res_row(data, results_format="json"):
     if "userInfo" in data:
         name = data["userInfo"]["name"]
         email = data["userInfo"]["email"]
@@ -42,22 +513,39 @@ def insert_res(con, data):
         oper_sys = data["platformInfo"]["os"]["vendor"]
     else:
         oper_sys = ""
-    data = {
+    row = {
         "name": name,
         "email": email,
         "gpu_vendor": data["platformInfo"]["gpu"]["vendor"],
+        "architecture": data["platformInfo"]["gpu"].get("architecture", ""),
+        "description": data["platformInfo"]["gpu"].get("description", ""),
         "browser": browser,
         "os": oper_sys,
         "framework": data["platformInfo"]["framework"],
-        "random_seed": data["randomSeed"],
-        "results": json.dumps(data)
+        "random_seed": data["randomSeed"]
     }
-    cursor.execute("""
+    row.update(validity_row(data, False))
+    text = json.dumps(data)
+    row["results"] = encode_results(data, results_format, text)
+    row["content_hash"] = content_hash(text)
+    return row
+
+insert_query = """
         INSERT INTO tuning_results
-            (name, email, gpu_vendor, browser, os, framework, random_seed, results)
+            (rowid, name, email, gpu_vendor, architecture, description, browser, os, framework, random_seed, results, content_hash,
+             valid, validation_error)
         VALUES
-            (:name, :email, :gpu_vendor, :browser, :os, :framework, :random_seed, :results)
-""", data)
+            (:rowid, :name, :email, :gpu_vendor, :architecture, :description, :browser, :os, :framework, :random_seed, :results,
+             :content_hash, :valid, :validation_error)
+"""
+
+def insert_res(con, data):
+    cursor = con.cursor()
+    create_table(cursor)
+    row = res_row(data)
+    row["rowid"] = None
+    cursor.execute(insert_query, row)
+    shred_res(cursor, cursor.lastrowid, data, row["content_hash"])
     con.commit()
 
 def create_legacy_table(cursor):
@@ -68,33 +556,149 @@ def create_legacy_table(cursor):
       )
 """)
 
-def insert_legacy_res(con, data):
-    cursor = con.cursor()
-    create_table(cursor)
-    data = {
+def legacy_res_row(data, results_format="json"):
+    text = json.dumps(data)
+    row = {
         "gpu_vendor": data["platformInfo"]["gpu"]["vendor"],
-        "results": json.dumps(data)
+        "architecture": data["platformInfo"]["gpu"].get("architecture", ""),
+        "description": data["platformInfo"]["gpu"].get("description", ""),
+        "results": encode_results(data, results_format, text),
+        "content_hash": content_hash(text)
     }
-    cursor.execute("""
+    row.update(validity_row(data, True))
+    return row
+
+legacy_insert_query = """
         INSERT INTO tuning_results
-            (gpu_vendor, results)
+            (rowid, gpu_vendor, architecture, description, results, content_hash, valid, validation_error)
         VALUES
-            (:gpu_vendor, :results)
-""", data)
+            (:rowid, :gpu_vendor, :architecture, :description, :results, :content_hash, :valid, :validation_error)
+"""
+
+def insert_legacy_res(con, data):
+    cursor = con.cursor()
+    create_table(cursor)
+    row = legacy_res_row(data)
+    row["rowid"] = None
+    cursor.execute(legacy_insert_query, row)
+    shred_res(cursor, cursor.lastrowid, data, row["content_hash"])
     con.commit()
 
+def expand_paths(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(glob.glob(os.path.join(path, "*.json")))
+        elif os.path.exists(path):
+            files.append(path)
+        else:
+            files += sorted(glob.glob(path))
+    return files
+
+# The tuning_results row and the normalized rows of a result, raising ValueError, KeyError or TypeError if it is malformed
+def prepare_data(data, is_legacy, results_format="json"):
+    if is_legacy:
+        row = legacy_res_row(data, results_format)
+    else:
+        row = res_row(data, results_format)
+    tests, params = shred(data)
+    return row, tests, params
+
+# Writes results returned by prepare_data and returns their rowids, which SQLite picks. Results whose content hash
+# is already in the database, or earlier in prepared, are skipped and get None. Call it after begin immediate, so
+# no other connection can write between the duplicate check and the inserts.
+def write_results(cursor, prepared, is_legacy):
+    hashes = [res[0]["content_hash"] for res in prepared]
+    seen = set()
+    for i in range(0, len(hashes), 500):
+        chunk = hashes[i:i + 500]
+        query = "select content_hash from tuning_results where content_hash in ({})".format(", ".join("?" * len(chunk)))
+        seen.update(row[0] for row in cursor.execute(query, chunk))
+    rowids = []
+    tests = []
+    params = []
+    shredded = []
+    for row, res_tests, res_params in prepared:
+        if row["content_hash"] in seen:
+            rowids.append(None)
+            continue
+        seen.add(row["content_hash"])
+        row["rowid"] = None
+        cursor.execute(legacy_insert_query if is_legacy else insert_query, row)
+        rowid = cursor.lastrowid
+        tests += [(rowid,) + test for test in res_tests]
+        params += [(rowid,) + param for param in res_params]
+        shredded.append((rowid, row["content_hash"]))
+        rowids.append(rowid)
+    insert_shredded(cursor, tests, params, shredded)
+    return rowids
+
+# Runs in the worker processes, so the parent only has to write rows
+def prepare_res(job):
+    path, is_legacy, results_format = job
+    try:
+        res = prepare_data(load_stats(path), is_legacy, results_format)
+    except (ValueError, KeyError, TypeError) as e:
+        return path, None, "{}: {}".format(type(e).__name__, e)
+    return path, res, os.path.getsize(path)
+
+def bulk_insert(con, paths, is_legacy, jobs, wal, results_format="json"):
+    from multiprocessing import Pool
+    start = time.perf_counter()
+    cursor = con.cursor()
+    if wal:
+        cursor.execute("pragma journal_mode=wal")
+    create_table(cursor)
+    create_shred_tables(cursor)
+    backfill_hashes(cursor)
+    backfill_device_columns(cursor)
+    con.commit()
+    num_bytes = 0
+    rowids = []
+    prepared = []
+    with Pool(jobs) as pool:
+        # Everything is written in a single transaction, a chunk at a time as the workers return them, so only one
+        # chunk is held in memory. The write lock is taken first, so results inserted by other connections are
+        # skipped too.
+        cursor.execute("begin immediate")
+        for path, res, info in pool.imap(prepare_res, [(path, is_legacy, results_format) for path in paths], chunksize=4):
+            if res is None:
+                print("Skipping {}: {}".format(path, info))
+                continue
+            num_bytes += info
+            prepared.append(res)
+            if len(prepared) == 100:
+                rowids += write_results(cursor, prepared, is_legacy)
+                prepared = []
+        rowids += write_results(cursor, prepared, is_legacy)
+    con.commit()
+    rows = [rowid for rowid in rowids if rowid is not None]
+    duplicates = len(rowids) - len(rows)
+    elapsed = time.perf_counter() - start
+    print("Inserted {} results ({} duplicates skipped) from {} files in {:.2f}s: {:.1f} files/s, {:.1f} MB/s".format(
+        len(rows), duplicates, len(paths), elapsed, len(paths)/elapsed, num_bytes/elapsed/1000000))
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("db_path", help="Path to sqlite database")
-    parser.add_argument("data_path", help="Path to data to insert")
+    parser.add_argument("data_paths", nargs="*", help="Files, directories or globs of results to insert")
     parser.add_argument("--legacy", action="store_true", help="Insert legacy Android app results")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Number of processes used to parse results")
+    parser.add_argument("--wal", action="store_true", help="Switch the database to write-ahead logging")
+    parser.add_argument("--migrate", action="store_true", help="Backfill the normalized test_results/iteration_params tables, content hashes, device columns, validity and indexes for existing rows, and create the stats cache and the tables of stored analyses")
+    parser.add_argument("--format", default="json", choices=["json", "zlib", "zstd", "msgpack"], help="Store results as JSON text or as a compressed BLOB")
+    parser.add_argument("--convert", action="store_true", help="Convert the results already in the database to --format")
     args = parser.parse_args()
     con = db_conn(args.db_path)
-    stats = load_stats(args.data_path)
-    if args.legacy:
-        insert_legacy_res(con, stats)
-    else:
-        insert_res(con, stats)
+    if args.migrate:
+        print("Migrated {} rows".format(migrate(con)))
+        return
+    if args.convert:
+        print("Converted {} rows to {}".format(convert(con, args.format), args.format))
+        return
+    if not args.data_paths:
+        parser.error("data_paths are required unless --migrate is given")
+    bulk_insert(con, expand_paths(args.data_paths), args.legacy, args.jobs, args.wal, args.format)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,256 @@
+import argparse
+import asyncio
+import json
+import signal
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from insert import (db_conn, create_table, create_shred_tables, backfill_hashes, backfill_device_columns, prepare_data,
+                    write_results, iter_p)
+from sketch import QuantileSketch
+
+statuses = {
+    200: "OK",
+    201: "Created",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    503: "Service Unavailable"
+}
+
+# Rejects submissions insert_res couldn't store or the analyses couldn't read
+def check_format(data):
+    if not isinstance(data, dict):
+        raise ValueError("results must be a JSON object")
+    iterations = [key for key in data if iter_p.match(key)]
+    if not iterations:
+        raise ValueError("results have no iterations")
+    for key in iterations:
+        if not isinstance(data[key], dict):
+            raise ValueError("iteration {} is not an object".format(key))
+        for test_key in data[key]:
+            if test_key == "params":
+                continue
+            for behavior in ["seq", "interleaved", "weak"]:
+                value = data[key][test_key][behavior]
+                if not isinstance(value, int) or value < 0:
+                    raise ValueError("{} of {} in iteration {} is not a count".format(behavior, test_key, key))
+
+def parse_submission(body, is_legacy, results_format):
+    data = json.loads(body)
+    check_format(data)
+    return prepare_data(data, is_legacy, results_format)
+
+# Accepts results over HTTP and hands them to a single writer, which commits them in batches. Submissions
+# wait for the commit of their batch, and are turned away once the queue stays full for put_timeout seconds.
+class Receiver:
+    def __init__(self, db_path, is_legacy, results_format="json", queue_size=1000, batch_size=100,
+                 batch_delay=0.05, put_timeout=5, max_bytes=64000000, wal=False, verbose=False):
+        self.db_path = db_path
+        self.is_legacy = is_legacy
+        self.results_format = results_format
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.put_timeout = put_timeout
+        self.max_bytes = max_bytes
+        self.wal = wal
+        self.verbose = verbose
+        self.counts = {"received": 0, "invalid": 0, "refused": 0, "inserted": 0, "duplicates": 0, "failed": 0, "batches": 0}
+        self.max_depth = 0
+        self.commit_seconds = QuantileSketch()
+        self.last_commit = None
+        # SQLite connections stay on the thread that opened them, so every write goes through this executor
+        self.db_executor = ThreadPoolExecutor(1)
+
+    def open_db(self):
+        self.con = db_conn(self.db_path)
+        cursor = self.con.cursor()
+        if self.wal:
+            cursor.execute("pragma journal_mode=wal")
+        create_table(cursor)
+        create_shred_tables(cursor)
+        backfill_hashes(cursor)
+        backfill_device_columns(cursor)
+        self.con.commit()
+
+    # Writes a batch in one transaction, returning the rowid of each submission, or None for duplicates
+    def write_batch(self, batch):
+        cursor = self.con.cursor()
+        start = time.perf_counter()
+        try:
+            # Other receivers or insert.py may write to the database too, so duplicates are checked under the write lock
+            cursor.execute("begin immediate")
+            rowids = write_results(cursor, batch, self.is_legacy)
+            self.con.commit()
+        except sqlite3.Error:
+            self.con.rollback()
+            raise
+        return rowids, time.perf_counter() - start
+
+    async def next_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        # Wait a little for more submissions, so a burst is committed at once
+        deadline = loop.time() + self.batch_delay
+        while len(batch) < self.batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def write_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            try:
+                rowids, seconds = await loop.run_in_executor(self.db_executor, self.write_batch, [item[0] for item in batch])
+            except sqlite3.Error as e:
+                self.counts["failed"] += len(batch)
+                print("Failed to write {} results: {}".format(len(batch), e), file=sys.stderr)
+                for item in batch:
+                    if not item[1].done():
+                        item[1].set_exception(e)
+                    self.queue.task_done()
+                continue
+            self.counts["batches"] += 1
+            self.counts["inserted"] += sum(rowid is not None for rowid in rowids)
+            self.counts["duplicates"] += sum(rowid is None for rowid in rowids)
+            self.commit_seconds.append(seconds)
+            self.last_commit = seconds
+            if self.verbose:
+                print("Committed {} results in {:.3f}s, {} queued".format(len(batch), seconds, self.queue.qsize()), file=sys.stderr)
+            for item, rowid in zip(batch, rowids):
+                if not item[1].done():
+                    item[1].set_result(rowid)
+                self.queue.task_done()
+
+    async def submit(self, body):
+        loop = asyncio.get_running_loop()
+        self.counts["received"] += 1
+        try:
+            prepared = await loop.run_in_executor(None, parse_submission, body, self.is_legacy, self.results_format)
+        except (ValueError, KeyError, TypeError) as e:
+            self.counts["invalid"] += 1
+            return 400, {"error": "Invalid results: {}: {}".format(type(e).__name__, e)}
+        future = loop.create_future()
+        try:
+            await asyncio.wait_for(self.queue.put((prepared, future)), self.put_timeout)
+        except asyncio.TimeoutError:
+            self.counts["refused"] += 1
+            return 503, {"error": "Too many results queued, retry later"}
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        try:
+            rowid = await future
+        except sqlite3.Error as e:
+            return 503, {"error": "Results could not be stored: {}".format(e)}
+        if rowid is None:
+            return 200, {"duplicate": True}
+        return 201, {"rowid": rowid}
+
+    def stats(self):
+        return {
+            "queueDepth": self.queue.qsize(),
+            "maxQueueDepth": self.max_depth,
+            "queueSize": self.queue_size,
+            "counts": self.counts,
+            "commitSeconds": {
+                "last": self.last_commit,
+                "mean": self.commit_seconds.sum / self.commit_seconds.count if self.commit_seconds.count else None,
+                "max": self.commit_seconds.max,
+                "p50": self.commit_seconds.quantile(0.5),
+                "p90": self.commit_seconds.quantile(0.9),
+                "p99": self.commit_seconds.quantile(0.99)
+            }
+        }
+
+    async def route(self, method, path, body):
+        if path == "/results":
+            if method != "POST":
+                return 405, {"error": "Results must be POSTed"}
+            return await self.submit(body)
+        if path == "/stats":
+            return 200, self.stats()
+        return 404, {"error": "Unknown path {}".format(path)}
+
+    async def handle(self, reader, writer):
+        try:
+            method, path, version = (await reader.readline()).decode("latin-1").split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1")
+                if line in ["\r\n", "\n", ""]:
+                    break
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get("content-length", 0))
+            if length > self.max_bytes:
+                status, response = 413, {"error": "Results are larger than {} bytes".format(self.max_bytes)}
+            else:
+                status, response = await self.route(method, path.split("?")[0], await reader.readexactly(length))
+        except (ValueError, asyncio.IncompleteReadError):
+            status, response = 400, {"error": "Malformed request"}
+        data = (json.dumps(response, indent=2) + "\n").encode()
+        headers = ["HTTP/1.1 {} {}".format(status, statuses[status]), "Content-Type: application/json",
+                   "Content-Length: {}".format(len(data)), "Connection: close"]
+        if status == 503:
+            headers.append("Retry-After: 1")
+        writer.write(("\r\n".join(headers) + "\r\n\r\n").encode() + data)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    async def serve(self, host, port, socket_path=None):
+        loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(self.queue_size)
+        await loop.run_in_executor(self.db_executor, self.open_db)
+        writer_task = asyncio.create_task(self.write_loop())
+        if socket_path:
+            server = await asyncio.start_unix_server(self.handle, socket_path)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        print("Receiving results into {} on {}".format(self.db_path, socket_path or "http://{}:{}".format(host, port)), file=sys.stderr)
+        stop = asyncio.Event()
+        for signum in [signal.SIGINT, signal.SIGTERM]:
+            loop.add_signal_handler(signum, stop.set)
+        await stop.wait()
+        # Stop accepting results, but commit the ones already queued
+        server.close()
+        await server.wait_closed()
+        await self.queue.join()
+        writer_task.cancel()
+        await loop.run_in_executor(self.db_executor, self.con.close)
+        print(json.dumps(self.stats()), file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("db_path", help="Path to sqlite database")
+    parser.add_argument("--legacy", action="store_true", help="Receive legacy Android app results")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8036, help="Port to listen on")
+    parser.add_argument("--socket", help="Listen on this Unix socket instead of a port")
+    parser.add_argument("--format", default="json", choices=["json", "zlib", "zstd", "msgpack"], help="Store results as JSON text or as a compressed BLOB")
+    parser.add_argument("--wal", action="store_true", help="Switch the database to write-ahead logging, so readers aren't blocked by commits")
+    parser.add_argument("--queue-size", type=int, default=1000, help="Number of results that can wait for the writer before new ones are turned away")
+    parser.add_argument("--batch-size", type=int, default=100, help="Maximum number of results committed at once")
+    parser.add_argument("--batch-delay", type=float, default=0.05, help="Seconds to wait for more results before committing a batch")
+    parser.add_argument("--put-timeout", type=float, default=5, help="Seconds a result waits for room in the queue before it is turned away")
+    parser.add_argument("--verbose", action="store_true", help="Print every commit to stderr")
+    args = parser.parse_args()
+    receiver = Receiver(args.db_path, args.legacy, args.format, args.queue_size, args.batch_size, args.batch_delay,
+                        args.put_timeout, wal=args.wal, verbose=args.verbose)
+    asyncio.run(receiver.serve(args.host, args.port, args.socket))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+import argparse
+import json
+import os
+import socketserver
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+from analyze import db_conn, Session, analyze_rowid, kmeans, kmeans_cache
+
+# Keeps a database's decoded stats and similarity matrices in memory between queries. Everything is dropped
+# when the database changes, i.e. another connection commits to it or the file is replaced.
+class Service:
+    def __init__(self, db_path, is_legacy, engine="json", cache=False):
+        self.db_path = db_path
+        self.is_legacy = is_legacy
+        self.engine = engine
+        self.cache = cache
+        self.cursor = None
+        self.file_id = None
+        self.version = None
+        self.sessions = {}
+        self.rowids = {}
+
+    def check(self):
+        stat = os.stat(self.db_path)
+        if self.cursor is None or self.file_id != (stat.st_dev, stat.st_ino):
+            self.cursor = db_conn(self.db_path)
+            self.file_id = (stat.st_dev, stat.st_ino)
+            self.version = None
+        # data_version changes whenever another connection commits, including other processes
+        version = self.cursor.execute("pragma data_version").fetchone()[0]
+        if version != self.version:
+            self.sessions = {}
+            self.rowids = {}
+            kmeans_cache.clear()
+            self.version = version
+
+    def session(self, mobile):
+        if mobile not in self.sessions:
+            self.sessions[mobile] = Session(self.cursor, self.is_legacy, mobile, self.engine, self.cache)
+        return self.sessions[mobile]
+
+    def analyze(self, group_by, vendor=None, mobile=False):
+        if group_by not in ["indiv", "vendor", "arch", "device", "all"]:
+            raise ValueError("group_by must be one of indiv, vendor, arch, device or all")
+        return self.session(mobile).analyze(group_by, vendor)
+
+    def analyze_rowid(self, rowid):
+        if rowid not in self.rowids:
+            if self.cursor.execute("select 1 from tuning_results where rowid = ?", [rowid]).fetchone() is None:
+                raise ValueError("No result with rowid {}".format(rowid))
+            self.rowids[rowid] = analyze_rowid(self.cursor, rowid, self.is_legacy, self.engine, self.cache)
+        return self.rowids[rowid]
+
+    def find_bugs(self, vendor=None, mobile=False):
+        return self.session(mobile).find_bugs(vendor)
+
+    def similarity(self, vendor=None, mobile=False):
+        if self.is_legacy:
+            raise ValueError("Legacy results have no tuning tests to compare devices by")
+        sim = self.session(mobile).similarity(vendor)
+        return {
+            "devices": list(sim["similarity"].index),
+            "vendors": sim["vendor_indices"],
+            "similarity": sim["similarity"].values.tolist(),
+            "avg": sim["avg"],
+            "median": sim["median"],
+            "max": sim["max"],
+            "min": sim["min"]
+        }
+
+    def kmeans(self, num_clusters, vendor=None, mobile=False, mode="exact", agreement=False):
+        if self.is_legacy:
+            raise ValueError("Legacy results have no tuning tests to compare devices by")
+        if mode not in ["exact", "minibatch", "pca"]:
+            raise ValueError("mode must be one of exact, minibatch or pca")
+        return kmeans(self.session(mobile).similarity(vendor), num_clusters, mode, agreement)
+
+    def status(self):
+        return {
+            "db": self.db_path,
+            "legacy": self.is_legacy,
+            "dataVersion": self.version,
+            "sessions": {str(mobile): len(self.sessions[mobile].rows) for mobile in self.sessions},
+            "rowids": len(self.rowids)
+        }
+
+    def query(self, path, params):
+        self.check()
+        vendor = params.get("vendor")
+        mobile = params.get("mobile", "0") not in ["0", "false", ""]
+        if path == "/analyze":
+            return self.analyze(params.get("group_by", "all"), vendor, mobile)
+        if path == "/rowid":
+            return self.analyze_rowid(int(params["rowid"]))
+        if path == "/bugs":
+            return self.find_bugs(vendor, mobile)
+        if path == "/similarity":
+            return self.similarity(vendor, mobile)
+        if path == "/kmeans":
+            agreement = params.get("agreement", "0") not in ["0", "false", ""]
+            return self.kmeans(int(params["clusters"]), vendor, mobile, params.get("mode", "exact"), agreement)
+        if path == "/status":
+            return self.status()
+        raise LookupError("Unknown query {}".format(path))
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        start = time.perf_counter()
+        try:
+            status, body = 200, self.server.service.query(url.path, params)
+        except KeyError as e:
+            status, body = 400, {"error": "Missing parameter {}".format(e)}
+        except ValueError as e:
+            status, body = 400, {"error": str(e)}
+        except LookupError as e:
+            status, body = 404, {"error": str(e)}
+        except SystemExit as e:
+            # Raised by analyze.py for databases that can't answer the query
+            status, body = 400, {"error": str(e)}
+        data = (json.dumps(body, indent=2) + "\n").encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("X-Query-Seconds", "{:.6f}".format(time.perf_counter() - start))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+class UnixHTTPServer(socketserver.UnixStreamServer):
+    pass
+
+def make_server(service, host="127.0.0.1", port=8035, socket_path=None, verbose=False):
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, Handler)
+    else:
+        server = HTTPServer((host, port), Handler)
+    server.service = service
+    server.verbose = verbose
+    return server
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("db_path", help="Path to sqlite database")
+    parser.add_argument("--legacy", action="store_true", help="Serve legacy Android app results")
+    parser.add_argument("--engine", default="json", choices=["json", "numpy", "sql"], help="Statistics engine, see analyze.py")
+    parser.add_argument("--cache", action="store_true", help="Reuse per test stats stored in the database by analyze.py --cache")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8035, help="Port to listen on")
+    parser.add_argument("--socket", help="Listen on this Unix socket instead of a port")
+    parser.add_argument("--preload", action="store_true", help="Decode the results and compute the similarity matrix before serving")
+    parser.add_argument("--verbose", action="store_true", help="Log every request to stderr")
+    args = parser.parse_args()
+    service = Service(args.db_path, args.legacy, args.engine, args.cache)
+    if args.preload:
+        service.check()
+        service.session(False)
+        if not args.legacy:
+            service.similarity()
+    server = make_server(service, args.host, args.port, args.socket, args.verbose)
+    print("Serving {} on {}".format(args.db_path, args.socket or "http://{}:{}".format(args.host, args.port)), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+import argparse
+import json
+from analyze import (db_conn, run_query, decode_results, flatten_dataset, flat_stats, all_tuning_tests, conformance_tests,
+                     vulkan_weak_mem_tests, filter_columns)
+
+# Bugs are found by conformance runs, which use the stress of the tuning tests of the same family,
+# e.g. messagePassingBarrier1 and messagePassingBarrier2 for messagePassingBarrier, rrMutant and rrRMWMutant for rr
+def bug_families(tests):
+    return {test: [i for i in range(len(tests)) if tests[i].startswith(test)] for test in conformance_tests}
+
+# Test durations with the time the computer was asleep left out, like stats_per_test: a test running longer
+# than a minute counts 0, and the next test counts once more for every such test before it
+def awake_durations(durations):
+    import numpy as np
+    awake = np.zeros(len(durations))
+    measured = np.flatnonzero(~np.isnan(durations))
+    sleeping = durations[measured] > 60
+    index = np.arange(len(measured))
+    last_awake = np.maximum.accumulate(np.where(sleeping, -1, index))
+    multipliers = index - np.r_[-1, last_awake[:-1]]
+    awake[measured] = np.where(sleeping, 0, durations[measured] * multipliers)
+    return awake
+
+# Per result the weak rate of every tuning test in every tuning iteration, the duration of each iteration
+# and the conformance bugs found. Legacy results have no durations, so each iteration counts one second.
+def load_replays(cursor, vendor, is_legacy, mobile, filters=None):
+    import numpy as np
+    tests = vulkan_weak_mem_tests if is_legacy else all_tuning_tests
+    families = bug_families(tests)
+    replays = []
+    for rowid, results in run_query(cursor, vendor, is_legacy, mobile, filters=filters):
+        data = decode_results(results, skip_params=True)
+        flat = flatten_dataset(data)
+        if not flat["tuning"].any():
+            continue
+        codes = np.array([tests.index(test) if test in tests else -1 for test in flat["tests"]], dtype=np.int64)[flat["test_codes"]]
+        entries = flat["tuning"] & (codes >= 0)
+        # Tuning iterations come first, numbered in stored order
+        iterations = np.unique(flat["iterations"][flat["tuning"]], return_inverse=True)[1]
+        counts = flat["counts"][flat["tuning"]]
+        rates = np.zeros((iterations.max() + 1, len(tests)), dtype=np.float32)
+        keep = entries[flat["tuning"]]
+        totals = counts[keep].sum(axis=1)
+        rates[iterations[keep], codes[flat["tuning"]][keep]] = counts[keep, 2] / np.maximum(totals, 1)
+        if is_legacy:
+            durations = np.ones(len(rates))
+        else:
+            durations = np.bincount(iterations, awake_durations(flat["durations"])[flat["tuning"]], minlength=len(rates))
+        bugs = np.zeros((len(conformance_tests), len(tests)), dtype=bool)
+        for test in flat_stats(flat, is_legacy)["bugs"]:
+            bugs[conformance_tests.index(test), families[test]] = True
+        replays.append({
+            "rowid": rowid,
+            "vendor": data["platformInfo"]["gpu"]["vendor"],
+            "rates": rates,
+            "durations": durations,
+            "bugs": bugs
+        })
+    return tests, replays
+
+def pad_chunk(replays):
+    import numpy as np
+    lengths = np.array([len(replay["rates"]) for replay in replays])
+    rates = np.zeros((len(replays), lengths.max(), replays[0]["rates"].shape[1]), dtype=np.float32)
+    durations = np.zeros((len(replays), lengths.max()))
+    for i in range(len(replays)):
+        rates[i, :lengths[i]] = replays[i]["rates"]
+        durations[i, :lengths[i]] = replays[i]["durations"]
+    bugs = np.stack([replay["bugs"] for replay in replays])
+    return lengths, rates, durations, bugs
+
+# Index of the last iteration run under a rule, for every order (axis 0) and result (axis 1)
+def stop_iterations(rule, budget, lengths, best_so_far, elapsed):
+    import numpy as np
+    valid = np.arange(best_so_far.shape[2])[None, None, :] < lengths[None, :, None]
+    if rule == "iterations":
+        stop = np.ceil(budget * lengths).astype(np.int64) - 1
+        stop = np.broadcast_to(stop, best_so_far.shape[:2])
+    elif rule == "seconds":
+        total = np.take_along_axis(elapsed, (lengths - 1)[None, :, None], axis=2)
+        stop = ((elapsed <= budget * total + 1e-9) & valid).sum(axis=2) - 1
+    else:
+        # Stop once budget iterations in a row didn't raise the best rate of any test
+        improved = np.concatenate([np.ones(best_so_far.shape[:2] + (1,), dtype=bool),
+                                   (best_so_far[:, :, 1:] > best_so_far[:, :, :-1]).any(axis=3)], axis=2)
+        index = np.arange(improved.shape[2])
+        since = index - np.maximum.accumulate(np.where(improved, index, -1), axis=2)
+        patience = (since >= budget) & valid
+        stop = np.where(patience.any(axis=2), patience.argmax(axis=2), lengths - 1)
+    return np.clip(stop, 0, lengths - 1)
+
+def init_totals():
+    return {"replays": 0, "timeUsed": 0.0, "iterationsUsed": 0.0, "weakTests": 0, "weakDetected": 0, "rateReached": 0,
+            "bugs": 0, "bugsKept": 0}
+
+# Replays a chunk of results in every order of orders (orders x results x iterations), adding the outcome of every
+# rule to totals[(rule, budget)][vendor]
+def replay_chunk(replays, orders, rules, threshold, totals):
+    import numpy as np
+    lengths, rates, durations, bugs = pad_chunk(replays)
+    rows = np.arange(len(replays))[None, :, None]
+    ordered_rates = rates[rows, orders]
+    best_so_far = np.maximum.accumulate(ordered_rates, axis=2)
+    elapsed = np.cumsum(durations[rows, orders], axis=2)
+    last = (lengths - 1)[None, :, None]
+    best = np.take_along_axis(best_so_far, last[..., None], axis=2)[:, :, 0]
+    total_time = np.take_along_axis(elapsed, last, axis=2)[:, :, 0]
+    # The family best rates of every bug, -1 where a test isn't in the family
+    family_best = np.where(bugs[None], best[:, :, None, :], -1).max(axis=3)
+    vendors = np.array([replay["vendor"] for replay in replays])
+    for rule, budget in rules:
+        stop = stop_iterations(rule, budget, lengths, best_so_far, elapsed)
+        found = np.take_along_axis(best_so_far, stop[:, :, None, None], axis=2)[:, :, 0]
+        time_used = np.take_along_axis(elapsed, stop[:, :, None], axis=2)[:, :, 0] / np.where(total_time > 0, total_time, 1)
+        weak = best > 0
+        family_found = np.where(bugs[None], found[:, :, None, :], -1).max(axis=3)
+        bug_kept = family_found >= threshold * family_best
+        for vendor in np.unique(vendors):
+            mask = vendors == vendor
+            vendor_totals = totals.setdefault((rule, budget), {}).setdefault(vendor, init_totals())
+            vendor_totals["replays"] += int(mask.sum()) * len(orders)
+            vendor_totals["timeUsed"] += float(time_used[:, mask].sum())
+            vendor_totals["iterationsUsed"] += float(((stop[:, mask] + 1) / lengths[mask]).sum())
+            vendor_totals["weakTests"] += int(weak[:, mask].sum())
+            vendor_totals["weakDetected"] += int((weak & (found > 0))[:, mask].sum())
+            vendor_totals["rateReached"] += int((weak & (found >= threshold * best))[:, mask].sum())
+            vendor_totals["bugs"] += int(bugs.any(axis=2)[mask].sum()) * len(orders)
+            vendor_totals["bugsKept"] += int((bug_kept & bugs.any(axis=2)[None])[:, mask].sum())
+
+def ratio(part, whole):
+    return part / whole if whole else None
+
+def summarize(totals):
+    return {
+        "replays": totals["replays"],
+        "timeSaved": 1 - totals["timeUsed"] / totals["replays"],
+        "iterationsSaved": 1 - totals["iterationsUsed"] / totals["replays"],
+        "weakDetected": ratio(totals["weakDetected"], totals["weakTests"]),
+        "rateReached": ratio(totals["rateReached"], totals["weakTests"]),
+        "bugsKept": ratio(totals["bugsKept"], totals["bugs"])
+    }
+
+# Replays every result under every rule, in stored order and in random orders of its iterations. Rules are
+# (iterations, fraction) and (seconds, fraction) budgets, and (patience, n) stopping after n iterations that
+# didn't improve the best rate of any test. A weak behavior is detected if the budget shows it at all, and its
+# rate reached if the best rate within the budget is at least threshold times the best rate of the whole run.
+# A bug is kept if the same holds for the best rate of its family of tuning tests.
+def simulate(replays, rules, permutations=20, threshold=0.9, seed=0, chunk_size=8000000):
+    import numpy as np
+    r = np.random.default_rng(seed)
+    results = {}
+    if not replays:
+        return results
+    max_length = max(len(replay["rates"]) for replay in replays)
+    num_tests = replays[0]["rates"].shape[1]
+    for order in ["stored", "random"]:
+        num_orders = 1 if order == "stored" else permutations
+        totals = {}
+        # Chunks of results are replayed at once, bounding the orders x results x iterations x tests arrays
+        rows = max(1, chunk_size // (num_orders * max_length * num_tests))
+        for start in range(0, len(replays), rows):
+            chunk = replays[start:start + rows]
+            lengths = np.array([len(replay["rates"]) for replay in chunk])
+            width = lengths.max()
+            if order == "stored":
+                orders = np.broadcast_to(np.arange(width), (1, len(chunk), width))
+            else:
+                # Padding sorts last, so every order is a permutation of a result's own iterations
+                keys = r.random((num_orders, len(chunk), width))
+                keys[:, np.arange(width)[None, :] >= lengths[:, None]] = np.inf
+                orders = np.argsort(keys, axis=2)
+            replay_chunk(chunk, orders, rules, threshold, totals)
+        for rule, budget in rules:
+            overall = init_totals()
+            for vendor_totals in totals[(rule, budget)].values():
+                for name in overall:
+                    overall[name] += vendor_totals[name]
+            for vendor, vendor_totals in [("all", overall)] + sorted(totals[(rule, budget)].items()):
+                results.setdefault(vendor, []).append(dict({"rule": rule, "budget": budget, "order": order}, **summarize(vendor_totals)))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("db_path", help="Path to sqlite database")
+    parser.add_argument("--legacy", action="store_true", help="Replay legacy Android app results")
+    parser.add_argument("--mobile", action="store_true", help="Replay mobile results")
+    parser.add_argument("--vendor", help="Only replay results from this vendor")
+    parser.add_argument("--budgets", default="0.1,0.25,0.5,0.75", help="Comma separated fractions of the iterations and of the time to stop after")
+    parser.add_argument("--patience", default="5,10,20", help="Comma separated numbers of iterations without a better rate to stop after")
+    parser.add_argument("--permutations", type=int, default=20, help="Number of random iteration orders replayed per result")
+    parser.add_argument("--threshold", type=float, default=0.9, help="Fraction of the best rate of the whole run a budget has to reach")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the iteration orders")
+    parser.add_argument("--output", help="Write the report to this JSON file")
+    for name in filter_columns:
+        parser.add_argument("--" + name, help="Only replay results with this gpu {}".format(name) if name in ["architecture", "description"] else "Only replay results with this {}".format(name))
+    args = parser.parse_args()
+    budgets = [float(budget) for budget in args.budgets.split(",") if budget]
+    rules = [("iterations", budget) for budget in budgets] + [("seconds", budget) for budget in budgets]
+    rules += [("patience", int(patience)) for patience in args.patience.split(",") if patience]
+    filters = {name: getattr(args, name) for name in filter_columns}
+    tests, replays = load_replays(db_conn(args.db_path), args.vendor, args.legacy, args.mobile, filters)
+    report = {
+        "results": len(replays),
+        "permutations": args.permutations,
+        "threshold": args.threshold,
+        "seed": args.seed,
+        "vendors": simulate(replays, rules, args.permutations, args.threshold, args.seed)
+    }
+    if args.output:
+        with open(args.output, "w") as out_file:
+            json.dump(report, out_file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import math
+import random
+
+# KLL quantile sketch (Karnin, Lang and Liberty, "Optimal Quantile Approximation in Streams", 2016).
+# Values are kept in levels of compactors, an item on level i standing for 2^i values. When a level is
+# full it is sorted and every other item moves up a level. Capacities shrink by 2/3 per level below the
+# top one, so at most about 3k values are kept however many are added.
+#
+# Error bound: a quantile q is returned as a value whose rank is within epsilon * count of q * count,
+# with epsilon about 1.7% for k = 200 at 99% confidence (and roughly inversely proportional to k).
+# min, max, count and sum are exact, as are all quantiles while fewer than k values have been added.
+# Sketches of parts of a stream can be merged, with the same error bound as a sketch of the whole stream.
+class QuantileSketch:
+    def __init__(self, k=200):
+        self.k = k
+        self.levels = [[]]
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.compactions = 0
+
+    def capacity(self, level):
+        return max(2, math.ceil(self.k * (2 / 3) ** (len(self.levels) - level - 1)))
+
+    def append(self, value):
+        self.levels[0].append(value)
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if len(self.levels[0]) >= self.capacity(0):
+            self.compress()
+
+    def compress(self):
+        compacted = True
+        while compacted:
+            compacted = False
+            for level in range(len(self.levels)):
+                if len(self.levels[level]) < self.capacity(level):
+                    continue
+                if level + 1 == len(self.levels):
+                    self.levels.append([])
+                items = sorted(self.levels[level])
+                # An odd item out stays on this level
+                self.levels[level] = items[len(items) - len(items) % 2:]
+                items = items[:len(items) - len(items) % 2]
+                # The offset is random, but seeded so the same values give the same sketch
+                offset = random.Random(self.compactions).getrandbits(1)
+                self.compactions += 1
+                self.levels[level + 1] += items[offset::2]
+                compacted = True
+                break
+
+    def merge(self, other):
+        while len(self.levels) < len(other.levels):
+            self.levels.append([])
+        for level in range(len(other.levels)):
+            self.levels[level] += other.levels[level]
+        self.count += other.count
+        self.sum += other.sum
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+        self.compactions += other.compactions
+        self.compress()
+        return self
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        if q <= 0:
+            return self.min
+        if q >= 1:
+            return self.max
+        items = sorted((value, 2 ** level) for level in range(len(self.levels)) for value in self.levels[level])
+        rank = q * self.count
+        weight = 0
+        for value, value_weight in items:
+            weight += value_weight
+            if weight >= rank:
+                return value
+        return self.max
+
+    def to_dict(self):
+        return {
+            "k": self.k,
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+            "compactions": self.compactions,
+            "levels": self.levels
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        sketch = cls(state["k"])
+        sketch.count = state["count"]
+        sketch.sum = state["sum"]
+        sketch.min = state["min"]
+        sketch.max = state["max"]
+        sketch.compactions = state["compactions"]
+        sketch.levels = state["levels"]
+        return sketch
@@ -0,0 +1,228 @@
+import argparse
+import json
+import os
+import random
+from analyze import all_tuning_tests, conformance_tests, vulkan_weak_mem_tests
+from insert import (db_conn, create_table, create_shred_tables, res_row, legacy_res_row, shred, insert_shredded,
+                    insert_query, legacy_insert_query)
+
+# Vendors, architectures and operating systems seen in the WebGPU results
+webgpu_devices = {
+    "intel": ["gen-12lp", "gen-11", "gen-9"],
+    "apple": ["common-3", "apple-7", "apple-8"],
+    "nvidia": ["ampere", "turing", "pascal"],
+    "amd": ["rdna-2", "rdna-1", "gcn-5"]
+}
+
+webgpu_os = ["Mac OS", "Windows", "Linux", "Chrome OS", "Android"]
+
+legacy_devices = {
+    "qualcomm": ["Adreno 610", "Adreno 640", "Adreno 642L", "Adreno 660"],
+    "arm": ["Mali - G71", "Mali - G78"],
+    "PowerVR": ["GE8320"],
+    "nvidia": ["Tegra X1"]
+}
+
+# Stress parameter ranges of the tuning runs in corr-analysis/*.json
+webgpu_param_ranges = {
+    "testingWorkgroups": (2, 32),
+    "maxWorkgroups": (4, 32),
+    "workgroupSize": (2, 128),
+    "shufflePct": (0, 100),
+    "barrierPct": (0, 100),
+    "memStressPct": (1, 100),
+    "memStressIterations": (5, 1023),
+    "memStressStoreFirstPct": (1, 100),
+    "memStressStoreSecondPct": (0, 100),
+    "preStressPct": (0, 100),
+    "preStressIterations": (0, 128),
+    "preStressStoreFirstPct": (0, 100),
+    "preStressStoreSecondPct": (0, 100),
+    "scratchMemorySize": (512, 524288),
+    "stressLineSize": (4, 1024),
+    "stressTargetLines": (2, 16),
+    "stressStrategyBalancePct": (1, 100),
+    "memStride": (1, 7)
+}
+
+# Stress parameter ranges of the tuning runs in dbs/vulkan.db
+legacy_param_ranges = {
+    "barrierPct": (0, 100),
+    "memStressIterations": (1, 1023),
+    "memStressPattern": (0, 3),
+    "memStressPct": (0, 100),
+    "memStride": (1, 7),
+    "preStressIterations": (0, 128),
+    "preStressPattern": (0, 3),
+    "preStressPct": (0, 100),
+    "scratchMemorySize": (128, 524288),
+    "shufflePct": (0, 100),
+    "stressAssignmentStrategy": (0, 1),
+    "stressLineSize": (4, 1024),
+    "stressTargetLines": (1, 16),
+    "testingWorkgroups": (2, 32)
+}
+
+def random_params(r, ranges):
+    params = {}
+    for name in ranges:
+        params[name] = r.randint(*ranges[name])
+    return params
+
+def device_profile(r, tests):
+    # How likely a device shows each weak behavior and how often it does so. About a third of the
+    # tests never show weak behaviors on a device, like in the collected results.
+    profile = {}
+    for test in tests:
+        if r.random() < 0.35:
+            profile[test] = (0, 0)
+        else:
+            profile[test] = (r.uniform(0.2, 1), r.uniform(0.0005, 0.05))
+    return profile
+
+def behaviors(r, total, weak_prob, weak_scale, stress):
+    weak = 0
+    if weak_prob and r.random() < weak_prob:
+        weak = min(total, int(total * weak_scale * stress * r.random()))
+    interleaved = int((total - weak) * r.uniform(0.05, 0.5))
+    return {
+        "seq": total - weak - interleaved,
+        "interleaved": interleaved,
+        "weak": weak
+    }
+
+def duration(r, seconds):
+    # Every few hundred tests the computer goes to sleep
+    if r.random() < 0.003:
+        return round(r.uniform(60, 3600), 3)
+    return round(seconds * r.uniform(0.9, 1.2), 3)
+
+def webgpu_submission(r, iterations=50):
+    vendor = r.choice(list(webgpu_devices))
+    profile = device_profile(r, all_tuning_tests)
+    seconds = r.uniform(0.5, 4)
+    dataset = {}
+    for i in range(iterations):
+        params = random_params(r, webgpu_param_ranges)
+        params["iterations"] = 100
+        total = params["iterations"] * params["testingWorkgroups"] * params["workgroupSize"]
+        stress = params["memStressPct"] / 100
+        iteration = {}
+        for test in all_tuning_tests:
+            iteration[test] = behaviors(r, total, *profile[test], stress)
+            iteration[test]["durationSeconds"] = duration(r, seconds)
+        iteration["params"] = params
+        dataset[str(i)] = iteration
+    # Conformance runs use the best parameters found while tuning, a few of them show bugs
+    for test in conformance_tests:
+        params = random_params(r, webgpu_param_ranges)
+        params["iterations"] = 100
+        total = params["iterations"] * params["testingWorkgroups"] * params["workgroupSize"]
+        dataset[str(len(dataset))] = {
+            test: dict(behaviors(r, total, 0.03, 0.0005, 1), durationSeconds=duration(r, seconds)),
+            "params": params
+        }
+    dataset["platformInfo"] = {
+        "gpu": {
+            "vendor": vendor,
+            "architecture": r.choice(webgpu_devices[vendor]),
+            "device": "",
+            "description": "{} {}".format(vendor, r.randint(1000, 99999))
+        },
+        "browser": {"vendor": "Chrome", "version": str(r.randint(110, 116))},
+        "os": {"vendor": r.choice(webgpu_os), "version": str(r.randint(10, 14))},
+        "framework": "webgpu"
+    }
+    dataset["randomSeed"] = "".join(r.choice("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ") for i in range(10))
+    if r.random() < 0.5:
+        dataset["userInfo"] = {"name": "", "email": ""}
+    return dataset
+
+def legacy_submission(r, iterations=150):
+    vendor = r.choice(list(legacy_devices))
+    profile = device_profile(r, vulkan_weak_mem_tests)
+    dataset = {}
+    for i in range(iterations):
+        params = random_params(r, legacy_param_ranges)
+        params["testIterations"] = 100
+        params["minWorkgroupSize"] = r.choice([4, 8, 16])
+        params["maxWorkgroupSize"] = params["minWorkgroupSize"] * 2
+        params["maxWorkgroups"] = params["testingWorkgroups"]
+        stress = params["memStressPct"] / 100
+        iteration = {}
+        for test in vulkan_weak_mem_tests:
+            # Every test picks its own workgroup size between the min and max
+            wg_size = r.randint(params["minWorkgroupSize"], params["maxWorkgroupSize"])
+            total = params["testIterations"] * params["testingWorkgroups"] * wg_size
+            iteration[test] = behaviors(r, total, *profile[test], stress)
+        iteration["params"] = params
+        dataset[str(i)] = iteration
+    dataset["platformInfo"] = {"gpu": {"vendor": vendor, "description": r.choice(legacy_devices[vendor])}}
+    dataset["randomSeed"] = "vulkan"
+    return dataset
+
+def submission(r, is_legacy, iterations):
+    if is_legacy:
+        return legacy_submission(r, iterations)
+    return webgpu_submission(r, iterations)
+
+def generate_db(db_path, rows, is_legacy, iterations, seed=0, batch_size=200):
+    r = random.Random(seed)
+    con = db_conn(db_path)
+    cursor = con.cursor()
+    create_table(cursor)
+    create_shred_tables(cursor)
+    next_rowid = cursor.execute("select coalesce(max(rowid), 0) from tuning_results").fetchone()[0] + 1
+    for start in range(0, rows, batch_size):
+        batch = []
+        tests = []
+        params = []
+        hashes = []
+        for i in range(min(batch_size, rows - start)):
+            dataset = submission(r, is_legacy, iterations)
+            if is_legacy:
+                row = legacy_res_row(dataset)
+            else:
+                row = res_row(dataset)
+            row["rowid"] = next_rowid
+            res_tests, res_params = shred(dataset)
+            batch.append(row)
+            tests += [(next_rowid,) + test for test in res_tests]
+            params += [(next_rowid,) + param for param in res_params]
+            hashes.append((next_rowid, row["content_hash"]))
+            next_rowid += 1
+        if is_legacy:
+            cursor.executemany(legacy_insert_query, batch)
+        else:
+            cursor.executemany(insert_query, batch)
+        insert_shredded(cursor, tests, params, hashes)
+        con.commit()
+
+def generate_files(out_dir, rows, is_legacy, iterations, seed=0):
+    r = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    for i in range(rows):
+        path = os.path.join(out_dir, "result-{}.json".format(i))
+        with open(path, "w") as out_file:
+            json.dump(submission(r, is_legacy, iterations), out_file)
+        paths.append(path)
+    return paths
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("out_path", help="Path to the sqlite database to write, or the directory of JSON files with --json")
+    parser.add_argument("--rows", type=int, default=100, help="Number of submissions to generate")
+    parser.add_argument("--legacy", action="store_true", help="Generate legacy Android app results")
+    parser.add_argument("--iterations", type=int, help="Number of tuning iterations per submission (default 50, or 150 for legacy)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--json", action="store_true", help="Write one JSON file per submission instead of a database")
+    args = parser.parse_args()
+    iterations = args.iterations or (150 if args.legacy else 50)
+    if args.json:
+        generate_files(args.out_path, args.rows, args.legacy, iterations, args.seed)
+    else:
+        generate_db(args.out_path, args.rows, args.legacy, iterations, args.seed)
+
+if __name__ == "__main__":
+    main()
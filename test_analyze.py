@@ -0,0 +1,100 @@
+import json
+import pytest
+import analyze
+from analyze import correlate
+from synth import generate_db
+
+def test_correlate_mixed_length_rows():
+    # Two tuning iterations and a conformance iteration, which only runs one test
+    dataset = {
+        "platformInfo": {},
+        "0": {"a": {"weak": 1}, "b": {"weak": 2}, "params": {}},
+        "1": {"a": {"weak": 3}, "b": {"weak": 5}, "params": {}},
+        "2": {"a": {"weak": 4}, "b": {"weak": 7}, "params": {}},
+        "3": {"a": {"weak": 0}, "params": {}}
+    }
+    corr = correlate(dataset)
+    assert list(corr.columns) == ["a", "b"]
+    assert corr.shape == (2, 2)
+    assert abs(corr.loc["a", "b"] - 1) < 1e-2
+
+def test_blocked_similarity_near_identical_rows():
+    import numpy as np
+    from analyze import blocked_similarity
+    # Rows a float32 rounding step longer than unit length, so their similarities come out just above 1
+    row = np.random.default_rng(0).random(64)
+    matrix = np.tile(row / np.linalg.norm(row) * (1 + 2 ** -23), (40, 1)).astype(np.float32)
+    meta = {"rowids": list(range(40)), "labels": ["device {}".format(i) for i in range(40)]}
+    result = blocked_similarity(matrix, meta, 3, block_size=16)
+    assert result["max"] > 1
+    assert 1 - 1e-4 < result["median"] <= 1
+
+def dumps(results):
+    return json.dumps(results, sort_keys=True)
+
+def test_group_stats_merge_matches_single_pass(synth_db):
+    cursor = analyze.db_conn(synth_db)
+    rows = list(analyze.row_stats(cursor, None, False, False))
+    for group_by in ["indiv", "vendor", "all"]:
+        whole = analyze.GroupStats(group_by, False)
+        parts = [analyze.GroupStats(group_by, False) for i in range(3)]
+        for i in range(len(rows)):
+            whole.update(*rows[i])
+            parts[i * 3 // len(rows)].update(*rows[i])
+        merged = parts[0].merge(parts[1]).merge(parts[2])
+        assert dumps(merged.finish()) == dumps(whole.finish())
+
+def test_jobs_match_serial_run(synth_db):
+    cursor = analyze.db_conn(synth_db)
+    for group_by in ["indiv", "vendor"]:
+        assert dumps(analyze.analyze(cursor, group_by, None, False, False, jobs=2)) == dumps(analyze.analyze(cursor, group_by, None, False, False))
+    assert dumps(analyze.find_bugs(cursor, None, False, False, jobs=2)) == dumps(analyze.find_bugs(cursor, None, False, False))
+
+def test_incremental_matches_full_run(synth_db):
+    cursor = analyze.db_conn(synth_db)
+    analyze.incremental_analyze(cursor, "vendor", None, False, False)
+    analyze.incremental_bugs(cursor, None, False, False)
+    generate_db(synth_db, 10, False, 10, seed=1)
+    assert dumps(analyze.incremental_analyze(cursor, "vendor", None, False, False)) == dumps(analyze.analyze(cursor, "vendor", None, False, False))
+    assert dumps(analyze.incremental_bugs(cursor, None, False, False)) == dumps(analyze.find_bugs(cursor, None, False, False))
+    # Changing an already processed row starts over
+    cursor.execute("update tuning_results set valid = 0 where rowid = 3")
+    cursor.connection.commit()
+    assert dumps(analyze.incremental_analyze(cursor, "vendor", None, False, False)) == dumps(analyze.analyze(cursor, "vendor", None, False, False))
+
+# Rollup groups keep sketches, which hold every value of groups this small, so only the sums can differ
+def test_rollup_matches_full_scan(synth_db):
+    cursor = analyze.db_conn(synth_db)
+    analyze.rollup_analyze(cursor, "vendor", None, False, False)
+    generate_db(synth_db, 10, False, 10, seed=1)
+    for group_by in ["all", "vendor", "device"]:
+        rollup = analyze.rollup_analyze(cursor, group_by, None, False, False)
+        full = analyze.analyze(cursor, group_by, None, False, False, quantiles="sketch")
+        assert list(rollup) == list(full)
+        for key in full:
+            for name in ["total", "counts", "maxRates", "minRates", "medianRates", "rateQuantiles", "timeQuantiles", "devices"]:
+                assert rollup[key][name] == full[key][name]
+            assert rollup[key]["time"] == pytest.approx(full[key]["time"])
+            assert rollup[key]["avgRates"] == pytest.approx(full[key]["avgRates"])
+
+# SQLite sums the durations in its own order, everything else is the same
+def test_sql_engine_matches_json(synth_db):
+    cursor = analyze.db_conn(synth_db)
+    json_rows = list(analyze.row_stats(cursor, None, False, False))
+    sql_rows = list(analyze.row_stats(cursor, None, False, False, "sql"))
+    assert [row[0] for row in sql_rows] == [row[0] for row in json_rows]
+    for (rowid, json_data, json_stats), (sql_rowid, sql_data, sql_stats) in zip(json_rows, sql_rows):
+        assert sql_data["platformInfo"] == json_data["platformInfo"]
+        assert sql_stats["time"] == pytest.approx(json_stats["time"])
+        del sql_stats["time"], json_stats["time"]
+        assert dumps(sql_stats) == dumps(json_stats)
+    bugs = list(analyze.row_stats(cursor, None, False, False, "sql", fields="bugs"))
+    assert [stats["bugs"] for rowid, data, stats in bugs] == [stats["bugs"] for rowid, data, stats in json_rows]
+
+# Quick queries must not pay for importing numpy, pandas or sklearn
+def test_quick_queries_import_no_heavy_modules(synth_db):
+    import os
+    from bench import heavy_modules, imported_modules
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "analyze.py")
+    for command in [["--rowid", "5"], ["--bugs"], ["--bugs", "--engine", "sql"]]:
+        assert set(heavy_modules) & imported_modules([script, synth_db] + command) == set()
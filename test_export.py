@@ -0,0 +1,14 @@
+import json
+import analyze
+from export import export
+
+def test_export_matches_database(synth_db, tmp_path):
+    cursor = analyze.db_conn(synth_db)
+    out_dir = str(tmp_path / "export")
+    assert export(cursor, out_dir, False) == 30
+    exported = analyze.load_export(out_dir)
+    for group_by in ["indiv", "vendor", "all"]:
+        from_export = analyze.group_rows(analyze.export_row_stats(exported, None, False), group_by, False)
+        assert json.dumps(from_export) == json.dumps(analyze.analyze(cursor, group_by, None, False, False))
+    bugs = analyze.collect_bugs(analyze.export_row_stats(exported, None, False), False)
+    assert json.dumps(bugs) == json.dumps(analyze.find_bugs(cursor, None, False, False))
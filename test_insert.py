@@ -0,0 +1,26 @@
+from insert import db_conn, decode_results, migrate, shred
+from synth import generate_db
+
+def shredded_rows(con, rowid):
+    return con.execute("select count(*) from test_results where result_id = ?", [rowid]).fetchone()[0]
+
+def expected_rows(con, rowid):
+    results = con.execute("select results from tuning_results where rowid = ?", [rowid]).fetchone()[0]
+    return len(shred(decode_results(results))[0])
+
+def test_shredded_rows_follow_their_result(synth_db):
+    con = db_conn(synth_db)
+    # SQLite gives the next result the rowid of a deleted last one
+    con.execute("delete from tuning_results where rowid = 30")
+    con.commit()
+    assert shredded_rows(con, 30) == 0
+    generate_db(synth_db, 1, False, 10, seed=1)
+    assert shredded_rows(con, 30) == expected_rows(con, 30)
+    # Changed results are shredded again by migrate
+    results = con.execute("select results from tuning_results where rowid = 29").fetchone()[0]
+    con.execute("update tuning_results set results = ? where rowid = 5", [results])
+    con.commit()
+    assert shredded_rows(con, 5) == 0
+    assert migrate(con) == 1
+    assert shredded_rows(con, 5) == expected_rows(con, 5)
+    assert migrate(con) == 0
@@ -0,0 +1,16 @@
+import json
+import analyze
+from simulate import load_replays, simulate
+
+def test_simulate_is_deterministic(synth_db):
+    rules = [("iterations", 0.5), ("seconds", 0.5), ("patience", 3)]
+    tests, replays = load_replays(analyze.db_conn(synth_db), None, False, False)
+    assert replays
+    first = simulate(replays, rules, permutations=5, seed=1)
+    # Replays are loaded again, so nothing carries over from the first run
+    tests, replays = load_replays(analyze.db_conn(synth_db), None, False, False)
+    assert json.dumps(simulate(replays, rules, permutations=5, seed=1)) == json.dumps(first)
+    # The seed only changes the random orders
+    other = simulate(replays, rules, permutations=5, seed=2)
+    stored = [row for row in first["all"] if row["order"] == "stored"]
+    assert stored == [row for row in other["all"] if row["order"] == "stored"]
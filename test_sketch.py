@@ -0,0 +1,33 @@
+import random
+from bisect import bisect_right
+from sketch import QuantileSketch
+
+# The rank of every quantile is within the documented 1.7% of the count, for a single sketch and for merged ones
+def test_quantile_error_bound():
+    r = random.Random(0)
+    values = [r.lognormvariate(0, 1) for i in range(50000)]
+    whole = QuantileSketch()
+    for value in values:
+        whole.append(value)
+    parts = [QuantileSketch() for i in range(10)]
+    for i in range(len(values)):
+        parts[i % 10].append(values[i])
+    merged = parts[0]
+    for part in parts[1:]:
+        merged.merge(part)
+    ordered = sorted(values)
+    for sketch in [whole, merged]:
+        assert sketch.count == len(values)
+        assert sketch.min == ordered[0] and sketch.max == ordered[-1]
+        assert sum(len(level) for level in sketch.levels) < 3 * sketch.k
+        for q in [0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99]:
+            rank = bisect_right(ordered, sketch.quantile(q))
+            assert abs(rank - q * len(values)) <= 0.017 * len(values)
+
+def test_small_sketches_are_exact():
+    sketch = QuantileSketch()
+    for value in range(100):
+        sketch.append(value)
+    restored = QuantileSketch.from_dict(sketch.to_dict())
+    assert [restored.quantile(q) for q in [0.25, 0.5, 1]] == [24, 49, 99]
+    assert restored.sum == sum(range(100))